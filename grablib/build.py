@@ -1,19 +1,132 @@
 import hashlib
 import json
+import os
 import re
 import shutil
 import tempfile
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from pathlib import Path
-from typing import Callable
+from typing import Callable, List, Optional, Tuple
 
 import click
 
-from .common import GrablibError, main_logger, progress_logger
+from .common import (GrablibError, fmt_size, main_logger, private_dir, progress_logger, read_json_cache, user_cache_dir,
+                     write_json_cache)
 
 STARTS_DOWNLOAD = re.compile('^(?:DOWNLOAD|DL)/')
 STARTS_NODE_M = re.compile('^(?:NODE_MODULES|NM)/')
 STARTS_SRC = re.compile('^SRC/')
+JSMIN_OPTIONS = {'quote_chars': '\'"`'}
+
+
+class ReplaceRules:
+    """
+    Regex find & replace rules compiled once and applied to any number of files.
+    """
+    _regex_chars = set('.^$*+?{}[]\\|()')
+
+    def __init__(self, replace: dict=None):
+        self._rules = []
+        for pattern, repl in (replace or {}).items():
+            # patterns without special characters can be ruled out with a substring check before running the regex
+            literal = pattern if not self._regex_chars.intersection(pattern) else None
+            self._rules.append((re.compile(pattern), repl, literal))
+
+    def __bool__(self):
+        return bool(self._rules)
+
+    def apply(self, content: str) -> Tuple[str, List[Tuple[str, str, int]]]:
+        """
+        Apply all rules to content.
+
+        :return: tuple of the modified content and pattern, replacement and number of substitutions for each rule
+        """
+        counts = []
+        for regex, repl, literal in self._rules:
+            if literal is not None and literal not in content:
+                count = 0
+            else:
+                content, count = regex.subn(repl, content)
+            counts.append((regex.pattern, repl, count))
+        return content, counts
+
+
+def _minify_source(content: str) -> str:
+    """
+    Minify javascript in a worker process, defined at module level so ProcessPoolExecutor can pickle it.
+    """
+    from jsmin import jsmin
+    return jsmin(content, **JSMIN_OPTIONS)
+
+
+class MinifyCache:
+    """
+    On disk cache of minified javascript keyed by a hash of the source, the jsmin version and its options so
+    libraries are only minified once however many builds and bundles they're used in.
+
+    Once the cache grows beyond max_size the least recently used entries are deleted.
+    """
+
+    def __init__(self, directory: Path, max_size: int):
+        self.directory = directory
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, minify_cache, max_size: int):
+        """
+        :param minify_cache: path to the cache directory, True to use "~/.cache/grablib/jsmin" or False to disable
+          the cache
+        :param max_size: maximum size of the cache in bytes
+        """
+        if not minify_cache:
+            return
+        elif minify_cache is True:
+            minify_cache = user_cache_dir('jsmin')
+        # cached content ends up in bundles unchecked, so refuse a directory anyone else could have written to
+        directory = private_dir(minify_cache, 'minify cache')
+        return directory and cls(directory, max_size)
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            content = path.read_text()
+        except FileNotFoundError:
+            return
+        # update mtime so eviction removes the least recently used entries first
+        os.utime(str(path))
+        return content
+
+    def add(self, key: str, content: str):
+        path = self._path(key)
+        path.parent.mkdir(mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.grablib-', suffix='.tmp', dir=str(path.parent))
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, str(path))
+
+    def evict(self):
+        files, total_size = [], 0
+        for path in self.directory.glob('*/*'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / key
 
 
 class Builder:
@@ -21,13 +134,42 @@ class Builder:
     main class for "building" assets eg. concatenating and minifying js and compiling sass
     """
 
-    def __init__(self, *, build_root, build, download_root: str=None, debug=False, **data):
+    def __init__(self, *,
+                 build_root,
+                 build,
+                 download_root: str=None,
+                 debug=False,
+                 build_workers: int=1,
+                 minify_cache=True,
+                 minify_cache_max_size: int=100 * 1024 ** 2,
+                 **data):
+        """
+        :param build_workers: number of processes to minify javascript with and bundles to assemble concurrently,
+          1 means build serially
+        :param minify_cache: directory to cache minified javascript in, True to use "~/.cache/grablib/jsmin"
+          (or under XDG_CACHE_HOME if set), False to disable the cache
+        :param minify_cache_max_size: size in bytes above which entries are evicted from the minify cache
+        """
         self.build_root = Path(build_root).absolute()
         self.build = build
         self.download_root = download_root and Path(download_root).resolve()
         self.files_built = 0
         self.debug = debug
+        self._workers = max(build_workers or 1, 1)
         self._jsmin = None
+        self._jsmin_version = None
+        # the cache directory is only created once something needs minifying
+        self._minify_cache_config = minify_cache, minify_cache_max_size
+        self._minify_cache = None
+        self._minify_cache_loaded = False
+        # minified content by key, so sources shared between dests are only minified once per build
+        self._minified = {}
+        self._replace_rules = {}
+        root_hash = hashlib.md5(str(self.build_root).encode()).hexdigest()
+        # inputs and outputs of each cat dest from the last build, used to skip dests which haven't changed
+        self._manifest_file = Path(tempfile.gettempdir()) / 'grablib_cat_manifest.{}.json'.format(root_hash)
+        self._old_manifest = {}
+        self._new_manifest = {}
 
     def __call__(self):
         wipe_data = self.build.get('wipe', None)
@@ -41,35 +183,115 @@ class Builder:
 
     def cat(self, data):
         start = datetime.now()
-        total_files_combined = 0
+        # a missing or unreadable manifest just means every dest is rebuilt
+        self._old_manifest = read_json_cache(self._manifest_file)
+        pending = []
         for dest, srcs in data.items():
             if not isinstance(srcs, list):
                 raise GrablibError('source files for concatenation should be a list')
-
-            final_content, files_combined = '', 0
-            for src in srcs:
-                if isinstance(src, str):
-                    src = {'src': src}
-                path = self._file_path(src['src'])
-                content = self._read_file(path)
-                files_combined += 1
-                for pattern, rep in src.get('replace', {}).items():
-                    content = re.sub(pattern, rep, content)
-                final_content += '/* === {} === */\n{}\n'.format(path.name, content.strip('\n'))
-                progress_logger.debug('  appending %s', path.name)
-
-            if files_combined == 0:
+            if not srcs:
                 main_logger.warning('no files found to form "%s"', dest)
                 continue
+
+            srcs = [{'src': src} if isinstance(src, str) else src for src in srcs]
+            paths = [self._file_path(src['src']) for src in srcs]
             dest_path = self._dest_path(dest)
-            dest_path.relative_to(self.build_root)
-            self._write(dest_path, final_content)
-            total_files_combined += files_combined
-            progress_logger.info('%d files combined to form "%s"', files_combined, dest)
+            inputs = self._cat_inputs(srcs, paths)
+            if self._cat_unchanged(dest_path, inputs):
+                progress_logger.info('sources of "%s" unchanged, not rebuilding', dest)
+                continue
+            rules = [self._get_replace_rules(src.get('replace')) for src in srcs]
+            pending.append((dest, paths, rules, dest_path, inputs))
 
+        if self._workers > 1 and pending:
+            self._minify_concurrently([path for _, paths, _, _, _ in pending for path in paths])
+            with ThreadPoolExecutor(max_workers=self._workers) as executor:
+                list(executor.map(lambda args: self._cat_dest(*args), pending))
+        else:
+            for args in pending:
+                self._cat_dest(*args)
+        total_files_combined = sum(len(paths) for _, paths, _, _, _ in pending)
+
+        write_json_cache(self._manifest_file, self._new_manifest)
+        self._minify_cache and self._minify_cache.evict()
         time_taken = (datetime.now() - start).total_seconds() * 1000
         main_logger.info('%d files concatenated in %0.0fms', total_files_combined, time_taken)
 
+    def _cat_dest(self, dest: str, paths: list, rules: list, dest_path: Path, inputs: list):
+        with self._open_atomic(dest_path) as f:
+            for path, replace_rules in zip(paths, rules):
+                content = self._read_file(path)
+                if replace_rules:
+                    content, _ = replace_rules.apply(content)
+                f.write('/* === {} === */\n'.format(path.name))
+                f.write(content.strip('\n'))
+                f.write('\n')
+                progress_logger.debug('  appending %s', path.name)
+
+        self._new_manifest[str(dest_path)] = {'inputs': inputs, 'output': self._file_signature(dest_path)}
+        progress_logger.info('%d files combined to form "%s"', len(paths), dest)
+
+    def _get_replace_rules(self, replace: dict) -> ReplaceRules:
+        """
+        Compile replace rules, sources with the same rules in different dests share one ReplaceRules instance.
+        """
+        key = tuple((replace or {}).items())
+        rules = self._replace_rules.get(key)
+        if rules is None:
+            rules = self._replace_rules[key] = ReplaceRules(replace)
+        return rules
+
+    def _minify_concurrently(self, paths: list):
+        """
+        Minify every distinct javascript source which isn't already cached using a pool of processes, results are
+        put in _minified so assembling the bundles doesn't have to minify anything itself.
+        """
+        to_minify = {}
+        for path in dict.fromkeys(paths):
+            if not self._needs_minify(path):
+                continue
+            content = path.read_text()
+            key = self._minify_key(content)
+            if key in self._minified or key in to_minify:
+                continue
+            cached = self.minify_cache and self.minify_cache.get(key)
+            if cached is None:
+                to_minify[key] = content
+            else:
+                self._minified[key] = cached
+
+        if len(to_minify) < 2:
+            return
+        main_logger.debug('minifying %d files with %d workers', len(to_minify), self._workers)
+        with ProcessPoolExecutor(max_workers=min(self._workers, len(to_minify))) as executor:
+            for key, minified in zip(to_minify, executor.map(_minify_source, to_minify.values())):
+                self._minified[key] = minified
+                self.minify_cache and self.minify_cache.add(key, minified)
+
+    def _cat_inputs(self, srcs, paths) -> list:
+        """
+        Everything which affects the content of a cat dest: the debug flag and each source's path, stat signature
+        and replace rules.
+        """
+        return [self.debug] + [[str(p)] + self._file_signature(p) + [s.get('replace')] for s, p in zip(srcs, paths)]
+
+    def _cat_unchanged(self, dest_path: Path, inputs: list) -> bool:
+        """
+        Check whether dest_path was built from the same inputs on the last run and hasn't been modified since.
+        """
+        entry = self._old_manifest.get(str(dest_path))
+        if not isinstance(entry, dict) or entry.get('inputs') != inputs or not dest_path.exists():
+            return False
+        if entry.get('output') != self._file_signature(dest_path):
+            return False
+        self._new_manifest[str(dest_path)] = entry
+        return True
+
+    @staticmethod
+    def _file_signature(path: Path) -> list:
+        stat = path.stat()
+        return [stat.st_size, stat.st_mtime_ns]
+
     def sass(self, data):
         for dest, d in data.items():
             if isinstance(d, str):
@@ -119,29 +341,72 @@ class Builder:
         else:
             return Path(src_path).resolve()
 
+    @property
+    def minify_cache(self) -> Optional[MinifyCache]:
+        if not self._minify_cache_loaded:
+            self._minify_cache = MinifyCache.from_config(*self._minify_cache_config)
+            self._minify_cache_loaded = True
+        return self._minify_cache
+
     @property
     def jsmin(self) -> Callable[[str, str], str]:
         if self._jsmin is None:
             try:
-                from jsmin import jsmin
+                import jsmin
             except ImportError as e:
                 main_logger.error('ImportError importing jsmin: %s', e)
                 raise GrablibError(
                     'Error importing jsmin. Build requirements probably not installed, run `pip install grablib[build]`'
                 ) from e
             else:
-                self._jsmin = jsmin
+                self._jsmin = jsmin.jsmin
+                self._jsmin_version = getattr(jsmin, '__version__', '')
         return self._jsmin
 
     def _read_file(self, file_path: Path):
         content = file_path.read_text()
-        if not self.debug and file_path.name.endswith('.js') and not file_path.name.endswith('.min.js'):
-            return self.jsmin(content, quote_chars='\'"`')
+        if self._needs_minify(file_path):
+            return self._minify(content)
         return content
 
-    def _write(self, new_path: Path, data):
+    def _needs_minify(self, file_path: Path) -> bool:
+        return not self.debug and file_path.name.endswith('.js') and not file_path.name.endswith('.min.js')
+
+    def _minify(self, content: str) -> str:
+        key = self._minify_key(content)
+        minified = self._minified.get(key)
+        if minified is None:
+            minified = self.minify_cache and self.minify_cache.get(key)
+            if minified is None:
+                minified = self.jsmin(content, **JSMIN_OPTIONS)
+                self.minify_cache and self.minify_cache.add(key, minified)
+            self._minified[key] = minified
+        return minified
+
+    def _minify_key(self, content: str) -> str:
+        # accessing jsmin first makes sure it's importable and sets _jsmin_version
+        self.jsmin
+        key_data = '{}\n{}\n{}'.format(self._jsmin_version, json.dumps(JSMIN_OPTIONS, sort_keys=True), content)
+        return hashlib.md5(key_data.encode()).hexdigest()
+
+    @contextmanager
+    def _open_atomic(self, new_path: Path):
+        """
+        Open a temporary file next to new_path for writing which is renamed to new_path once the block exits
+        without error, so a bundle is never left half written.
+        """
         new_path.parent.mkdir(parents=True, exist_ok=True)
-        new_path.write_text(data)
+        tmp_path = str(new_path.parent / '.grablib-{}.tmp'.format(uuid.uuid4().hex))
+        # unlike mkstemp which creates files only readable by the owner, this lets the kernel apply the umask
+        # so built files get the same permissions open() would give them
+        fd = os.open(tmp_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                yield f
+            os.replace(tmp_path, str(new_path))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
 
 class SassGenerator:
@@ -168,7 +433,8 @@ class SassGenerator:
             self._src_dir = self._in_dir
         self._include = re.compile(include or '/[^_][^/]+\.(?:css|sass|scss)$')
         self._exclude = exclude and re.compile(exclude)
-        self._replace = replace or {}
+        self._replace = [(re.compile(path_regex), ReplaceRules(regex_map))
+                         for path_regex, regex_map in (replace or {}).items()]
         self.download_root = download_root
         self._nm = self._find_node_modules()
         self._old_size_cache = {}
@@ -259,16 +525,16 @@ class SassGenerator:
 
     def _regex_modify(self, rel_path, css):
         log_msg = None
-        for path_regex, regex_map in self._replace.items():
-            if re.search(path_regex, str(rel_path)):
-                progress_logger.debug('%s has regex replace matches for "%s"', rel_path, path_regex)
-                for pattern, repl in regex_map.items():
-                    hash1 = hash(css)
-                    css = re.sub(pattern, repl, css)
-                    if hash(css) == hash1:
-                        log_msg = '  "{}" ➤ "{}" didn\'t modify the source'.format(pattern, repl)
-                    else:
+        rel_path_str = str(rel_path)
+        for path_regex, rules in self._replace:
+            if rules and path_regex.search(rel_path_str):
+                progress_logger.debug('%s has regex replace matches for "%s"', rel_path, path_regex.pattern)
+                css, counts = rules.apply(css)
+                for pattern, repl, count in counts:
+                    if count:
                         log_msg = '  "{}" ➤ "{}" modified the source'.format(pattern, repl)
+                    else:
+                        log_msg = '  "{}" ➤ "{}" didn\'t modify the source'.format(pattern, repl)
         return css, log_msg
 
     def _log_file_creation(self, rel_path, css_path, css):
@@ -314,15 +580,3 @@ class SassGenerator:
                 'Error importing sass. Build requirements probably not installed, run `pip install grablib[build]`'
             ) from e
         return sass
-
-
-KB, MB = 1024, 1024 ** 2
-
-
-def fmt_size(num):
-    if num <= KB:
-        return '{:0.0f}B'.format(num)
-    elif num <= MB:
-        return '{:0.1f}KB'.format(num / KB)
-    else:
-        return '{:0.1f}MB'.format(num / MB)
@@ -11,16 +11,22 @@ click.disable_unicode_literals_warning = True
 
 @click.command()
 @click.version_option(VERSION, '-V', '--version')
-@click.argument('action', type=click.Choice(['download', 'build']), required=False, metavar='[download / build]')
+@click.argument('action', type=click.Choice(['download', 'build', 'verify']), required=False,
+                metavar='[download / build / verify]')
 @click.option('-f', '--config-file', type=click.Path(exists=True, dir_okay=False, file_okay=True), required=False)
 @click.option('--debug/--no-debug', 'debug', default=None)
 @click.option('-v/-q', '--verbose/--quiet', 'verbose', default=None)
-def cli(action, config_file, debug, verbose):
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=None,
+              help='number of files to download or minify at once')
+@click.option('--paranoid', is_flag=True, default=None, help='hash every existing file instead of trusting mtimes')
+def cli(action, config_file, debug, verbose, jobs, paranoid):
     """
     Static asset management in python.
 
     Called with no arguments grablib will download, then build. You can also choose to only download or build.
 
+    "verify" checks downloaded files match the lock file without downloading anything.
+
     See `grablib -h` and https://github.com/samuelcolvin/grablib for more help.
     """
     if verbose is True:
@@ -33,11 +39,13 @@ def cli(action, config_file, debug, verbose):
 
     setup_logging(log_level)
     try:
-        grab = Grab(config_file, debug=debug)
+        grab = Grab(config_file, debug=debug, download_workers=jobs, build_workers=jobs, paranoid=paranoid)
         if action in {'download', None}:
             grab.download()
         if action in {'build', None}:
             grab.build()
+        if action == 'verify':
+            grab.verify()
     except GrablibError as e:
         click.secho('Error: %s' % e, fg='red')
         sys.exit(2)
@@ -1,6 +1,10 @@
+import json
 import logging
 import logging.config
-from typing import Union
+import os
+import tempfile
+from pathlib import Path
+from typing import Optional, Union
 
 import click
 
@@ -85,3 +89,72 @@ class GrablibError(RuntimeError):
     Exception used when the error is clear so no traceback is required.
     """
     pass
+
+
+def user_cache_dir(name: str) -> Path:
+    """
+    Default location of a cache private to the current user, "~/.cache/grablib/<name>" or under XDG_CACHE_HOME
+    if it's set.
+    """
+    return Path(os.getenv('XDG_CACHE_HOME', '~/.cache')) / 'grablib' / name
+
+
+def private_dir(directory, description: str) -> Optional[Path]:
+    """
+    Create directory readable only by the current user if it doesn't exist, returns None with a warning if it
+    can't be created or if someone else could write to it, in which case its content can't be trusted.
+    """
+    try:
+        directory = Path(directory).expanduser().absolute()
+        directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+        stat = directory.stat()
+    except (OSError, RuntimeError) as e:
+        main_logger.warning('unable to create %s directory "%s", not using it: %s', description, directory, e)
+        return
+    if (hasattr(os, 'getuid') and stat.st_uid != os.getuid()) or stat.st_mode & 0o022:
+        main_logger.warning('%s directory "%s" is not owned by the current user or is writable by others, '
+                            'not using it', description, directory)
+        return
+    return directory
+
+
+def read_json_cache(path: Path) -> dict:
+    """
+    Load a cache saved with write_json_cache, a missing or unreadable cache is treated as empty.
+    """
+    try:
+        with path.open() as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        main_logger.warning('unable to read cache "%s", ignoring it: %s', path, e)
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def write_json_cache(path: Path, data: dict):
+    """
+    Save data as json to a temporary file and move it to path so the cache is never left half written.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix='.grablib-', suffix='.tmp', dir=str(path.parent))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, str(path))
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+KB, MB = 1024, 1024 ** 2
+
+
+def fmt_size(num):
+    if num <= KB:
+        return '{:0.0f}B'.format(num)
+    elif num <= MB:
+        return '{:0.1f}KB'.format(num / KB)
+    else:
+        return '{:0.1f}MB'.format(num / MB)
@@ -1,15 +1,38 @@
+import asyncio
 import hashlib
+import io
 import json
+import os
 import re
+import shutil
+import struct
+import tarfile
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
 from collections import OrderedDict
-from io import BytesIO as IO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from pathlib import Path
+from stat import S_ISREG
+from typing import Callable, Optional, Tuple
+from urllib.parse import quote, unquote, urlsplit
 
 import requests
-from requests.exceptions import RequestException
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, Timeout
+from urllib3.util.retry import Retry
 
-from .common import GrablibError, main_logger, progress_logger
+from .common import (GrablibError, fmt_size, main_logger, private_dir, progress_logger, read_json_cache, user_cache_dir,
+                     write_json_cache)
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 ALIASES = {
     'GITHUB': 'https://raw.githubusercontent.com',
@@ -17,7 +40,583 @@ ALIASES = {
 }
 ZIP_VALUE_REF = ':zip-lookup'
 ZIP_RAW_REF = ':zip-raw'
+# hash of the central directory of archives which were only partially downloaded, see RemoteZip
+ZIP_INDEX_REF = ':zip-index'
+ARCHIVE_REFS = {ZIP_RAW_REF, ZIP_INDEX_REF}
+ETAG_REF = ':etag'
+LAST_MODIFIED_REF = ':last-modified'
+# validators saved in the lock: response header they're taken from and request header used to send them
+VALIDATORS = OrderedDict([
+    (ETAG_REF, ('ETag', 'If-None-Match')),
+    (LAST_MODIFIED_REF, ('Last-Modified', 'If-Modified-Since')),
+])
+# where url was last redirected to, saved in the lock alongside validators so redirects needn't be followed
+LOCATION_REF = ':location'
 STALE = ':stale'
+FILENAME_REGEX = re.compile(r'(?:^|/)(?P<filename>[^/]+)$')
+MD5_REGEX = re.compile('[0-9a-f]{32}')
+TARBALL_REGEX = re.compile(r'\.(?:tar(?:\.\w+)?|tgz|tbz2?|txz)$')
+REGEX_SPECIAL = set('.^$*+?{}[]\\|()')
+CHUNK_SIZE = 64 * 1024
+CACHE_ENV = 'GRABLIB_CACHE_DIR'
+# end of central directory record plus the longest possible comment
+ZIP_TAIL_SIZE = zipfile.sizeEndCentDir + 0xffff
+RANGE_BLOCK = 64 * 1024
+MAX_RANGE_BLOCK = 8 * 1024 ** 2
+MIRROR_PROBE_TIMEOUT = 2
+# ioctl to create a copy on write clone of a file on btrfs, xfs etc.
+FICLONE = 0x40049409
+# server errors which are retried, others won't go away by trying again
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+class DownloadedFile:
+    """
+    Content of a url streamed to a temporary file, the md5 hash is calculated as chunks are written so the
+    file doesn't need to be read again or held in memory.
+
+    Used as a context manager the temporary file is always removed on exit unless it's been moved into place.
+    """
+
+    def __init__(self, directory: Path):
+        directory.mkdir(parents=True, exist_ok=True)
+        self.size = 0
+        self.hash = None
+        # ETag and Last-Modified values from the response, see VALIDATORS
+        self.validators = {}
+        self._md5 = hashlib.md5()
+        self.path, self._f = self._open(directory)
+
+    def _open(self, directory: Path):
+        fd, path = tempfile.mkstemp(prefix='.grablib-', suffix='.tmp', dir=str(directory))
+        return Path(path), os.fdopen(fd, 'wb')
+
+    def write(self, chunk: bytes):
+        self._f.write(chunk)
+        self._md5.update(chunk)
+        self.size += len(chunk)
+
+    def write_from(self, f):
+        """
+        Copy the contents of a file object in chunks.
+        """
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            self.write(chunk)
+
+    def close(self):
+        self._f.close()
+        self.hash = self._md5.hexdigest()
+
+    def move_to(self, new_path: Path):
+        """
+        Atomically move the file to new_path, existing files are replaced.
+        """
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(str(self.path), str(new_path))
+
+    def delete(self):
+        self._f.close()
+        if self.path.exists():
+            self.path.unlink()
+
+    @contextmanager
+    def cleanup_on_error(self):
+        try:
+            yield
+        except BaseException:
+            self.delete()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.delete()
+
+
+class PartialDownload(DownloadedFile):
+    """
+    Download to a file named after the url which is kept if the download fails part way through so the next
+    attempt can resume it with a Range request.
+
+    If-Range is sent with the validator from the original response so the server returns the whole file
+    if it has changed.
+    """
+
+    def __init__(self, directory: Path, url: str, *, resume: bool=True):
+        self._name = '.grablib-{}.part'.format(hashlib.md5(url.encode()).hexdigest())
+        self._validator_path = directory / (self._name + '-validator')
+        self._resume = resume
+        self._range_validator = None
+        super().__init__(directory)
+
+    def _open(self, directory: Path):
+        path = directory / self._name
+        if self._resume and path.exists() and self._validator_path.exists():
+            self._range_validator = self._validator_path.read_text()
+            with path.open('rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    self._md5.update(chunk)
+                    self.size += len(chunk)
+            return path, path.open('ab')
+        return path, path.open('wb')
+
+    def range_headers(self) -> dict:
+        if self.size and self._range_validator:
+            return {'Range': 'bytes={}-'.format(self.size), 'If-Range': self._range_validator}
+        return {}
+
+    def resumes_at(self, headers) -> bool:
+        """
+        Check the Content-Range of a 206 response starts where the partial file ends.
+        """
+        m = re.match(r'bytes (\d+)-', headers.get('Content-Range', ''))
+        return bool(self.size and m and int(m.group(1)) == self.size)
+
+    def restart(self, headers=None):
+        """
+        Discard any partial content, headers of the new response are used to find the validator needed to
+        resume the download later.
+        """
+        self._f.seek(0)
+        self._f.truncate()
+        self._md5 = hashlib.md5()
+        self.size = 0
+        self._range_validator = None
+        if headers:
+            etag = headers.get('ETag')
+            # weak etags can't be used with If-Range
+            if etag and not etag.startswith('W/'):
+                self._range_validator = etag
+            else:
+                self._range_validator = headers.get('Last-Modified')
+
+    def abort(self):
+        """
+        Keep the partial file if the download can be resumed, otherwise delete it.
+        """
+        if self.size and self._range_validator:
+            self._f.close()
+            self._validator_path.write_text(self._range_validator)
+        else:
+            self.delete()
+
+    def move_to(self, new_path: Path):
+        super().move_to(new_path)
+        self._delete_validator()
+
+    def delete(self):
+        super().delete()
+        self._delete_validator()
+
+    def _delete_validator(self):
+        if self._validator_path.exists():
+            self._validator_path.unlink()
+
+
+def clone_file(src: Path, dst: Path, *, hardlink: bool=False, copy: bool=True) -> Optional[str]:
+    """
+    Copy src to dst, which mustn't exist, letting the kernel do the work where possible rather than passing
+    the content through python.
+
+    :param hardlink: whether to try creating a hard link to src before copying
+    :param copy: whether to copy the content if neither a hard link nor a reflink is possible, if False dst
+      isn't created and None is returned in that case
+    :return: method used: "hardlink", "reflink", "copy_file_range", "sendfile" or "copy"
+    """
+    if hardlink:
+        try:
+            os.link(str(src), str(dst))
+        except OSError:
+            pass
+        else:
+            return 'hardlink'
+    with src.open('rb') as fsrc, dst.open('xb') as fdst:
+        if fcntl:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                pass
+            else:
+                return 'reflink'
+        if copy:
+            size = os.fstat(fsrc.fileno()).st_size
+            for method in ('copy_file_range', 'sendfile'):
+                if hasattr(os, method) and _copy_with(getattr(os, method), fsrc, fdst, size):
+                    return method
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+            return 'copy'
+    dst.unlink()
+
+
+def _copy_with(copy, fsrc, fdst, size: int) -> bool:
+    """
+    Copy using os.copy_file_range or os.sendfile, False if the file systems don't support it.
+    """
+    copied = 0
+    while copied < size:
+        try:
+            if copy is os.sendfile:
+                sent = copy(fdst.fileno(), fsrc.fileno(), copied, size - copied)
+            else:
+                sent = copy(fsrc.fileno(), fdst.fileno(), size - copied, copied, copied)
+        except OSError:
+            if copied:
+                raise
+            return False
+        if not sent:
+            break
+        copied += sent
+    return True
+
+
+class LocalFile(DownloadedFile):
+    """
+    Copy of a local file in a temporary file made with clone_file, the hash is of the source file.
+    """
+
+    def __init__(self, directory: Path, source: Path, hash_: str, *, hardlink: bool=False):
+        super().__init__(directory)
+        self._f.close()
+        self.path.unlink()
+        with self.cleanup_on_error():
+            self.method = clone_file(source, self.path, hardlink=hardlink)
+        self.size = self.path.stat().st_size
+        self.hash = hash_
+
+    def close(self):
+        pass
+
+
+class DownloadCache:
+    """
+    User level content addressed store of downloaded files which can be shared between projects.
+
+    Files are stored by their md5 hash so they can be found using the hash in the lock file, once the cache
+    grows beyond max_size the least recently used files are deleted.
+    """
+
+    def __init__(self, directory: Path, max_size: int=None):
+        self.directory = directory
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, download_cache, max_size: int):
+        """
+        :param download_cache: path to the cache directory, True to use the default location or False to
+          disable the cache even if the environment variable is set
+        :param max_size: maximum size of the cache in bytes
+        """
+        if download_cache is False:
+            return
+        elif isinstance(download_cache, str):
+            directory = Path(download_cache)
+        elif os.getenv(CACHE_ENV):
+            directory = Path(os.getenv(CACHE_ENV))
+        elif download_cache is True:
+            directory = Path(os.getenv('XDG_CACHE_HOME', '~/.cache')) / 'grablib'
+        else:
+            return
+        return cls(directory.expanduser().absolute(), max_size)
+
+    def get(self, hash_: str, temp_dir: Path) -> Optional[DownloadedFile]:
+        """
+        Copy the file with the given hash from the cache to a temporary file in temp_dir.
+        """
+        path = self._path(hash_)
+        try:
+            f = path.open('rb')
+        except FileNotFoundError:
+            return
+        download = DownloadedFile(temp_dir)
+        with f:
+            download.write_from(f)
+        download.close()
+        if download.hash != hash_:
+            progress_logger.warning('cached file %s is corrupt, deleting it', path)
+            download.delete()
+            self._unlink(path)
+            return
+        # update mtime so eviction removes the least recently used files first
+        os.utime(str(path))
+        return download
+
+    def add(self, download: DownloadedFile):
+        path = self._path(download.hash)
+        if path.exists():
+            os.utime(str(path))
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.grablib-', suffix='.tmp', dir=str(path.parent))
+        os.close(fd)
+        shutil.copyfile(str(download.path), tmp_path)
+        os.replace(tmp_path, str(path))
+
+    def evict(self):
+        files, total_size = [], 0
+        for path, stat in self._entries():
+            files.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        evicted = 0
+        for _, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            self._unlink(path)
+            total_size -= size
+            evicted += 1
+        evicted and progress_logger.debug('%d files evicted from download cache', evicted)
+
+    def retain(self, hashes: set):
+        """
+        Delete all files from the cache except those with the given hashes, the cache directory itself is
+        removed if that leaves it empty.
+        """
+        for path, _ in self._entries():
+            if path.name not in hashes:
+                self._unlink(path)
+        try:
+            for prefix_dir in self.directory.iterdir():
+                if re.fullmatch('[0-9a-f]{2}', prefix_dir.name) and prefix_dir.is_dir():
+                    # rmdir only removes empty directories
+                    self._rmdir(prefix_dir)
+            self._rmdir(self.directory)
+        except FileNotFoundError:
+            pass
+
+    def _entries(self):
+        """
+        Yield the path and stat of every file in the cache, anything else in the directory is ignored so
+        it's never deleted.
+        """
+        for path in self.directory.glob('*/*'):
+            if not MD5_REGEX.fullmatch(path.name) or path.parent.name != path.name[:2]:
+                continue
+            try:
+                stat = path.lstat()
+            except FileNotFoundError:
+                continue
+            if S_ISREG(stat.st_mode):
+                yield path, stat
+
+    def _path(self, hash_: str) -> Path:
+        return self.directory / hash_[:2] / hash_
+
+    @staticmethod
+    def _rmdir(path: Path):
+        try:
+            path.rmdir()
+        except OSError:
+            pass
+
+    @staticmethod
+    def _unlink(path: Path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+class ZipRoutes:
+    """
+    Extraction rules for an archive compiled once, each member is routed to the first rule which matches.
+
+    Every rule is checked against its literal prefix before the regex itself is tried, so for large archives
+    most members are rejected by most rules with a simple string comparison.
+    """
+
+    def __init__(self, value: dict):
+        self.rules = []
+        for pattern, targets in value.items():
+            if isinstance(targets, str):
+                targets = [targets]
+            self.rules.append((self.literal_prefix(pattern), re.compile(pattern), pattern, targets))
+
+    def route(self, filepath: str):
+        """
+        :return: tuple of (pattern, targets, match) for the first rule matching filepath or None
+        """
+        for prefix, regex, pattern, targets in self.rules:
+            if filepath.startswith(prefix):
+                m = regex.match(filepath)
+                if m:
+                    return pattern, targets, m
+
+    @staticmethod
+    def literal_prefix(pattern: str) -> str:
+        """
+        Find the characters any string matching pattern must start with.
+        """
+        if '|' in pattern:
+            # alternation could apply to the start of the pattern
+            return ''
+        prefix = ''
+        for c in pattern:
+            if c in REGEX_SPECIAL:
+                if c in '*?{':
+                    # quantifier means the previous character is optional
+                    prefix = prefix[:-1]
+                break
+            prefix += c
+        return prefix
+
+
+class RemoteZip(io.RawIOBase):
+    """
+    Read only file object for a zip archive on a server supporting Range requests, bytes are fetched as zipfile
+    reads them so only the central directory and the members actually extracted are downloaded.
+
+    Consecutive reads fetch increasingly large blocks so big members don't need a request per chunk.
+
+    Requests are made with a callable taking the url and headers and returning the status code, headers and
+    content of the response, the content should be empty unless the status is 206.
+    """
+
+    def __init__(self, request: Callable[[str, dict], Tuple[int, dict, bytes]], url: str, size: int, tail: bytes,
+                 headers):
+        super().__init__()
+        self.url = url
+        self.size = size
+        self.fetched = len(tail)
+        self.index_hash = None
+        self.headers = headers
+        self.validators = {}
+        self._request = request
+        etag = headers.get('ETag')
+        # If-Range means a 200 response is returned instead of the range if the archive changes
+        self._range_validator = etag if etag and not etag.startswith('W/') else headers.get('Last-Modified')
+        self._pos = 0
+        self._tail = size - len(tail), tail
+        self._buffer = 0, b''
+        self._block = RANGE_BLOCK
+
+    @classmethod
+    def open(cls, request: Callable[[str, dict], Tuple[int, dict, bytes]], url: str) -> Optional['RemoteZip']:
+        """
+        Request the end of the archive, returns None if the server doesn't support Range requests.
+        """
+        status, headers, content = request(url, {'Range': 'bytes=-{}'.format(ZIP_TAIL_SIZE)})
+        m = status == 206 and re.match(r'bytes \d+-\d+/(\d+)$', headers.get('Content-Range', ''))
+        if not m:
+            return
+        return cls(request, url, int(m.group(1)), content, headers)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._pos = offset
+        return self._pos
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self._pos + size, self.size)
+        data = b''
+        while self._pos < end:
+            chunk = self._buffered(end)
+            if not chunk:
+                self._fetch(end)
+                continue
+            data += chunk
+            self._pos += len(chunk)
+        return data
+
+    def _buffered(self, end) -> bytes:
+        for offset, buffer in (self._tail, self._buffer):
+            if offset <= self._pos < offset + len(buffer):
+                return buffer[self._pos - offset:end - offset]
+        return b''
+
+    def _fetch(self, end):
+        start = self._pos
+        offset, buffer = self._buffer
+        if start == offset + len(buffer):
+            self._block = min(self._block * 2, MAX_RANGE_BLOCK)
+        else:
+            self._block = RANGE_BLOCK
+        stop = min(max(end, start + self._block), self.size)
+        headers = {'Range': 'bytes={}-{}'.format(start, stop - 1)}
+        if self._range_validator:
+            headers['If-Range'] = self._range_validator
+        status, response_headers, content = self._request(self.url, headers)
+        content_range = response_headers.get('Content-Range', '')
+        if status != 206 or not content_range.startswith('bytes {}-'.format(start)) or not content:
+            progress_logger.error('Unexpected response to range request: %d %s', status, content_range)
+            raise GrablibError('remote archive changed')
+        self.fetched += len(content)
+        self._buffer = start, content
+
+
+class RateLimiter:
+    """
+    Limit the combined speed of all downloads, each chunk is given a time slot after the slots already
+    reserved by other threads or tasks.
+    """
+
+    def __init__(self, rate: int):
+        """
+        :param rate: bytes per second
+        """
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def reserve(self, size: int) -> float:
+        """
+        Reserve time for size bytes.
+
+        :return: seconds to wait before continuing
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + size / self.rate
+            return start - now
+
+
+class DeadlineExceeded(Timeout):
+    pass
+
+
+class RetryStatus(Exception):
+    """
+    Raised by AsyncDownloader for a response with a status in RETRY_STATUSES which should be retried.
+    """
+
+
+class TransportAdapter(HTTPAdapter):
+    """
+    HTTP adapter which retries connection errors and server errors with exponential backoff and applies
+    default timeouts to every request.
+
+    Once deadline is set the timeouts of each request are capped by the time remaining before it.
+    """
+
+    def __init__(self, *, timeout, retries: int, backoff: float, pool_size: int):
+        self.timeout = timeout
+        self.deadline = None
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES, raise_on_status=False)
+        super().__init__(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+
+    def send(self, request, timeout=None, **kwargs):
+        timeout = timeout or self.timeout
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded('download deadline exceeded', request=request)
+            if isinstance(timeout, tuple):
+                timeout = tuple(remaining if t is None else min(t, remaining) for t in timeout)
+            else:
+                timeout = remaining if timeout is None else min(timeout, remaining)
+        return super().send(request, timeout=timeout, **kwargs)
 
 
 class Downloader:
@@ -30,65 +629,449 @@ class Downloader:
                  download: dict,
                  aliases: dict=None,
                  lock: str='.grablib.lock',
+                 download_workers: int=1,
+                 download_cache=None,
+                 download_cache_max_size: int=1024 ** 3,
+                 paranoid: bool=False,
+                 archive_cache=True,
+                 zip_ranges: bool=False,
+                 download_timeout=(10, 60),
+                 download_retries: int=3,
+                 download_backoff: float=0.5,
+                 download_deadline: float=None,
+                 download_pool_size: int=None,
+                 hardlink_local: bool=False,
+                 dedup: bool=False,
+                 host_concurrency: int=4,
+                 download_rate_limit: int=None,
                  **data):
         """
         :param download_root: path to download file to
         :param downloads: dict of urls and paths to download from from > to
-        :param aliases: extra aliases for download addresses
+        :param aliases: extra aliases for download addresses, values may be a list of mirrors which are tried
+          fastest first, the first mirror is used in the lock file
+        :param download_workers: number of urls to download concurrently, 1 means download serially
+        :param download_cache: directory of the cache shared between projects, True to use "~/.cache/grablib",
+          if not set the cache is only used when the GRABLIB_CACHE_DIR environment variable is set
+        :param download_cache_max_size: size in bytes above which files are evicted from the cache
+        :param paranoid: whether to hash every existing file rather than trusting hashes cached when the file's
+          size, mtime and inode haven't changed
+        :param archive_cache: directory to keep the archives currently in the lock file so files can be extracted
+          again without downloading them, True to use "~/.cache/grablib/archives"; archives are kept in a
+          subdirectory specific to download_root since archives no longer in this project's lock are deleted;
+          not used if download_cache is enabled since that already keeps archives
+        :param zip_ranges: whether to download only the central directory and the members needed from archives
+          not already pinned by a full download in the lock file, this requires the server to support Range
+          requests, otherwise the whole archive is downloaded; only used by the synchronous downloader.
+          The lock then pins the central directory, which includes each member's CRC32 but no cryptographic
+          hash: files already in the lock are checked against their md5, but members extracted for the first
+          time (eg. after changing extraction rules) are only as trustworthy as CRC32
+        :param download_timeout: timeout in seconds for connecting to servers and waiting for data, either one
+          number for both or a list of [connect, read]
+        :param download_retries: number of times to retry a request after a connection error or 5xx response
+        :param download_backoff: backoff factor between retries, the nth retry waits backoff * 2 ^ (n - 1) seconds
+        :param download_deadline: time in seconds after which downloading is abandoned, by default unlimited
+        :param download_pool_size: number of connections to keep open to each host, defaults to the larger of
+          10 and download_workers
+        :param hardlink_local: whether to hard link files from local sources into download_root when they're on
+          the same file system rather than copying them, changes to either file will then change both
+        :param dedup: whether to hard link (or reflink where hard links aren't possible) files in download_root
+          with the same content to each other rather than writing a copy of each
+        :param host_concurrency: maximum number of requests to make at once to any one host
+        :param download_rate_limit: maximum combined download speed in bytes per second, by default unlimited
         """
         self.download_root = Path(download_root).absolute()
         self.download = download
         self._aliases = ALIASES.copy()
         aliases and self._aliases.update(aliases)
+        # first mirror of each alias with more than one mirror > all its mirrors
+        self._mirrors = {}
+        self._mirror_order = {}
+        for name, value in self._aliases.items():
+            if isinstance(value, list):
+                self._aliases[name] = value[0]
+                if len(value) > 1:
+                    self._mirrors[value[0]] = value
         self._downloaded = 0
         self._skipped = 0
         self._stale_deleted = 0
         self._lock_file = lock and Path(lock)
         self._new_lock = []
-        self._current_lock = self._stale_files = None
+        self._current_lock = self._current_validators = self._stale_files = None
+        self._workers = max(download_workers or 1, 1)
+        if isinstance(download_timeout, list):
+            download_timeout = tuple(download_timeout)
+        self._timeout = download_timeout
+        self._deadline_seconds = download_deadline
+        self._deadline = None
+        self._retries = download_retries
+        self._backoff = download_backoff
+        self._adapter = TransportAdapter(
+            timeout=download_timeout,
+            retries=download_retries,
+            backoff=download_backoff,
+            pool_size=download_pool_size or max(10, self._workers),
+        )
         self._session = requests.Session()
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+        # guards _new_lock, _stale_files and the counters when downloading concurrently
+        self._mutex = threading.Lock()
+        # separate from _mutex so probing mirrors doesn't hold up other threads updating the lock
+        self._mirror_mutex = threading.Lock()
+        self._cache = DownloadCache.from_config(download_cache, download_cache_max_size)
+        self._paranoid = paranoid
+        root_hash = hashlib.md5(str(self.download_root).encode()).hexdigest()
+        # kept next to the lock file (or in download_root without one) rather than somewhere shared since
+        # its entries are trusted as the hashes of files
+        if self._lock_file:
+            self._stat_cache_file = self._lock_file.with_name(self._lock_file.name + '.stat-cache')
+        else:
+            self._stat_cache_file = self.download_root / '.grablib.stat-cache'
+        self._old_stat_cache = {}
+        self._new_stat_cache = {}
+        self._zip_ranges = zip_ranges
+        self._hardlink_local = hardlink_local
+        self._dedup = dedup
+        self._host_concurrency = max(host_concurrency or 1, 1)
+        self._host_semaphores = {}
+        self._rate_limiter = download_rate_limit and RateLimiter(download_rate_limit)
+        # hash > a path in download_root with that content, used to find duplicates in dedup mode
+        self._dedup_index = {}
+        self._archive_cache = None
+        if archive_cache and not self._cache:
+            if archive_cache is True:
+                archive_cache = user_cache_dir('archives')
+            # a directory per project which grablib owns, so retain() never touches anything else
+            archive_dir = private_dir(Path(archive_cache) / 'grablib_archives.{}'.format(root_hash), 'archive cache')
+            self._archive_cache = archive_dir and DownloadCache(archive_dir)
 
     def __call__(self):
         """
         perform download and save.
         """
+        entries = self._start()
+        if self._workers > 1 and len(entries) > 1:
+            self._process_concurrently(entries)
+        else:
+            for url, value in entries:
+                self._process_entry(url, value)
+        self._finish()
+
+    def verify(self):
+        """
+        Check the files in download_root match the lock file without making any requests, every file is hashed
+        in full using a pool of threads.
+        """
+        if not (self._lock_file and self._lock_file.exists()):
+            raise GrablibError('lock file "{}" not found, unable to verify'.format(self._lock_file))
+        main_logger.info('verifying files in: %s', self.download_root)
+        current_lock, _, _ = self._read_lock()
+        expected = {}
+        for url, name_hashes in current_lock.items():
+            if isinstance(name_hashes, tuple):
+                name_hashes = [name_hashes]
+            name_hashes = [(n, h) for n, h in name_hashes if n != ZIP_VALUE_REF and n not in ARCHIVE_REFS]
+            expected.update({name: (url, h) for name, h in name_hashes})
+
+        names = sorted(expected)
+        paths = [self.download_root.joinpath(name) for name in names]
+        with ThreadPoolExecutor(max_workers=max(self._workers, os.cpu_count() or 1)) as executor:
+            hashes = executor.map(self._hash_if_exists, paths)
+            file_hashes = dict(zip(names, hashes))
+
+        problems = {'missing': 0, 'modified': 0, 'stale': 0}
+        for name in names:
+            url, lock_hash = expected[name]
+            problem = self._verify_problem(url, lock_hash, file_hashes[name])
+            if problem:
+                progress_logger.error('%s: %s', problem, name)
+                problems[problem] += 1
+            else:
+                progress_logger.debug('ok: %s', name)
+        main_logger.info('%d files checked, %d missing, %d modified, %d stale',
+                         len(names), problems['missing'], problems['modified'], problems['stale'])
+        if any(problems.values()):
+            raise GrablibError('verification failed')
+
+    @staticmethod
+    def _verify_problem(url, lock_hash, file_hash) -> Optional[str]:
+        if url == STALE:
+            return 'stale' if file_hash else None
+        elif file_hash is None:
+            return 'missing'
+        elif file_hash != lock_hash:
+            return 'modified'
+
+    def _start(self):
         main_logger.info('downloading files to: %s', self.download_root)
+        if self._deadline_seconds:
+            self._deadline = self._adapter.deadline = time.monotonic() + self._deadline_seconds
+        self._current_lock, self._current_validators, self._stale_files = self._read_lock()
+        if self._dedup:
+            for name, hash_ in self._stale_files.items():
+                if not name.startswith(':'):
+                    self._dedup_index.setdefault(hash_, self.download_root.joinpath(name))
+        self._old_stat_cache = read_json_cache(self._stat_cache_file)
+        return [(self._setup_url(url_base), value) for url_base, value in self.download.items()]
 
-        self._current_lock, self._stale_files = self._read_lock()
-        for url_base, value in self.download.items():
-            url = self._setup_url(url_base)
-            try:
-                if isinstance(value, dict):
-                    self._process_zip(url, value)
-                else:
-                    self._process_normal_file(url, value)
-            except GrablibError as e:
-                # create new exception to show which file download went wrong for
-                if isinstance(value, OrderedDict):
-                    value = dict(value)
-                raise GrablibError('Error downloading "{}" to "{}"'.format(url, value)) from e
+    def _finish(self):
         self._delete_stale()
         self._save_lock()
+        write_json_cache(self._stat_cache_file, self._new_stat_cache)
+        if self._archive_cache:
+            self._archive_cache.retain({v['hash'] for v in self._new_lock if v['name'] == ZIP_RAW_REF})
+        self._cache and self._cache.evict()
         main_logger.info('Download finished: %d files downloaded, %d stale files deleted, %d existing and ignored',
                          self._downloaded, self._stale_deleted, self._skipped)
 
-    def _process_normal_file(self, url, dst):
-        new_path = self._file_path(url, dst, regex=r'/(?P<filename>[^/]+)$')
+    def _process_concurrently(self, entries):
+        """
+        Process entries using a pool of threads, errors are raised in the order the entries are defined
+        so the outcome matches the serial case.
+        """
+        main_logger.debug('downloading with %d workers', self._workers)
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            futures = [executor.submit(self._process_entry, url, value) for url, value in entries]
+            try:
+                for future in futures:
+                    future.result()
+            except GrablibError:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def _process_entry(self, url, value):
+        with self._entry_errors(url, value):
+            save = self._prepare_entry(url, value)
+            if save:
+                download = self._from_cache(url, value) or self._remote_zip(url, value)
+                with download or self._to_cache(url, value, self._get_url(url)) as download:
+                    save(download)
+
+    @contextmanager
+    def _entry_errors(self, url, value):
+        try:
+            yield
+        except GrablibError as e:
+            # create new exception to show which file download went wrong for
+            if isinstance(value, OrderedDict):
+                value = dict(value)
+            raise GrablibError('Error downloading "{}" to "{}"'.format(url, value)) from e
+
+    def _prepare_entry(self, url, value) -> Optional[Callable[[DownloadedFile], None]]:
+        """
+        Check whether url needs downloading, if so return a function which should be called with the
+        downloaded file to save it.
+        """
+        if isinstance(value, dict):
+            local_path = self._local_path(url)
+            if local_path and local_path.is_dir():
+                return self._copy_local_dir(url, local_path, value)
+            return self._prepare_zip(url, value)
+        else:
+            return self._prepare_normal_file(url, value)
+
+    @staticmethod
+    def _local_path(url) -> Optional[Path]:
+        """
+        Find the path of a local source, either a file:// url or a plain path, None if url is remote.
+        """
+        if url.startswith('file://'):
+            return Path(unquote(urlsplit(url).path))
+        elif '://' not in url:
+            return Path(url)
+
+    def _copy_local_dir(self, url, directory: Path, value):
+        """
+        Copy files from a local directory using the same rules as archives. Directories have no hash in the lock
+        file so are copied on every run, files with unchanged content are left untouched; while the rules are
+        unchanged each file must still match the hash it was locked with.
+        """
+        value_hash = self._data_hash(json.dumps(value, sort_keys=True).encode())
+        locked_hashes = self._locked_member_hashes(url, value_hash)
+        self._lock(url, ZIP_VALUE_REF, value_hash)
+        routes = ZipRoutes(value)
+        copied = 0
+        for path in sorted(directory.glob('**/*')):
+            if path.is_file():
+                for new_path in self._member_paths(routes, path.relative_to(directory).as_posix()):
+                    copied += self._copy_local_file(url, path, new_path, locked_hashes)
+        if copied:
+            progress_logger.info('%d files copied from %s', copied, directory)
+            self._count('_downloaded')
+        else:
+            progress_logger.debug('%s already exists unchanged, not copying', url)
+            self._count('_skipped')
+
+    def _copy_local_file(self, url, path: Path, new_path: Path, locked_hashes: dict) -> int:
+        hash_ = self._path_hash(path)
+        name = str(new_path.relative_to(self.download_root))
+        lock_hash = locked_hashes.get(name)
+        if lock_hash and lock_hash != hash_:
+            progress_logger.error('Security warning: hash of "%s" copied from %s has changed!', name, url)
+            raise GrablibError('remote hash mismatch')
+        if self._same_content(new_path, path.stat().st_size, hash_):
+            self._lock_unchanged_member(url, new_path)
+            return 0
+        with LocalFile(new_path.parent, path, hash_, hardlink=self._hardlink_local) as local_file:
+            self._place(local_file, [new_path])
+        self._lock(url, name, hash_)
+        return 1
+
+    def _entry_cache(self, url, value) -> Optional[DownloadCache]:
+        """
+        Cache to use for an entry, archives are kept locally even if the shared download cache isn't enabled.
+        """
+        if self._local_path(url):
+            return
+        elif self._cache:
+            return self._cache
+        elif isinstance(value, dict):
+            return self._archive_cache
+
+    def _from_cache(self, url, value) -> Optional[DownloadedFile]:
+        cache = self._entry_cache(url, value)
+        lock_hash = cache and self._remote_lock_hash(url)
+        if lock_hash:
+            download = cache.get(lock_hash, self.download_root)
+            if download:
+                progress_logger.debug('%s found in %s', url, cache.directory)
+                download.validators = self._current_validators.get(url, {})
+                return download
+
+    def _to_cache(self, url, value, download: DownloadedFile) -> DownloadedFile:
+        cache = self._entry_cache(url, value)
+        cache and cache.add(download)
+        return download
+
+    def _remote_zip(self, url, value) -> Optional[RemoteZip]:
+        """
+        Open an archive for extraction with Range requests if zip_ranges is enabled, returns None if the full
+        archive should be downloaded instead.
+        """
+        if not (self._zip_ranges and isinstance(value, dict)) or self._local_path(url) or self._remote_lock_hash(url):
+            # a hash of the full archive in the lock can only be checked by downloading all of it
+            return
+        if TARBALL_REGEX.search(urlsplit(url).path):
+            # tarballs have no index so must be read in full
+            return
+        remote = RemoteZip.open(self._range_request, url)
+        if remote is None:
+            progress_logger.info('%s doesn\'t support range requests, downloading the whole archive', url)
+            return
+        remote.index_hash = self._zip_index_hash(remote)
+        if remote.index_hash is None:
+            progress_logger.info('unable to read the central directory of %s, downloading the whole archive', url)
+            remote.close()
+            return
+        remote.validators = self._response_validators(remote.headers)
+        return remote
+
+    @staticmethod
+    def _zip_index_hash(f) -> Optional[str]:
+        """
+        Find the md5 hash of the central directory of a zip file, this includes the name, size and CRC32 of every
+        member so can be used to check the archive hasn't changed without reading all of it.
+
+        :return: None if the end of central directory record isn't found or the archive is zip64
+        """
+        f.seek(0, io.SEEK_END)
+        tail_start = max(f.tell() - ZIP_TAIL_SIZE, 0)
+        f.seek(tail_start)
+        tail = f.read()
+        end_pos = tail.rfind(zipfile.stringEndArchive)
+        if end_pos < 0 or len(tail) - end_pos < zipfile.sizeEndCentDir:
+            return
+        cd_size, cd_offset = struct.unpack('<LL', tail[end_pos + 12:end_pos + 20])
+        if cd_offset == 0xffffffff or cd_size > tail_start + end_pos:
+            return
+        # the central directory immediately precedes the end record even if there's data before the archive
+        f.seek(tail_start + end_pos - cd_size)
+        return hashlib.md5(f.read(cd_size)).hexdigest()
+
+    def _remote_lock_hash(self, url) -> Optional[str]:
+        """
+        Find the hash of the raw content of url from the current lock.
+        """
+        name_hashes = self._current_lock.get(url)
+        if isinstance(name_hashes, tuple):
+            return name_hashes[1]
+        for name, hash_ in name_hashes or []:
+            if name == ZIP_RAW_REF:
+                return hash_
+
+    def _conditional_request(self, url) -> Tuple[Optional[Path], dict]:
+        """
+        If url has validators in the lock and a local copy of its content exists, return that copy and the
+        headers to make a conditional request, a 304 response then means the local copy can be used.
+        """
+        validators = self._current_validators.get(url, {})
+        headers = {VALIDATORS[ref][1]: value for ref, value in validators.items() if ref in VALIDATORS}
+        reuse_path = headers and self._reusable_path(url)
+        if not reuse_path:
+            return None, {}
+        return reuse_path, headers
+
+    def _reusable_path(self, url) -> Optional[Path]:
+        """
+        Find a local file with the same content as url was when the lock was created.
+        """
+        name_hash = self._current_lock.get(url)
+        if isinstance(name_hash, tuple):
+            name, lock_hash = name_hash
+            path = self.download_root.joinpath(name)
+            if self._path_hash(path) == lock_hash:
+                return path
+
+    def _not_modified(self, url, reuse_path: Path, headers) -> DownloadedFile:
+        progress_logger.info('%s not modified, reusing local copy', url)
+        download = DownloadedFile(self.download_root)
+        with download.cleanup_on_error():
+            with reuse_path.open('rb') as f:
+                download.write_from(f)
+            download.close()
+        download.validators = dict(self._current_validators[url], **self._response_validators(headers))
+        return download
+
+    @staticmethod
+    def _response_validators(headers) -> dict:
+        validators = {}
+        for ref, (response_header, _) in VALIDATORS.items():
+            value = headers.get(response_header)
+            if value:
+                validators[ref] = value
+        return validators
+
+    def _lock_validators(self, url, validators: dict):
+        for ref, value in (validators or {}).items():
+            self._lock(url, ref, quote(value, safe='"/:,'))
+
+    def _count(self, counter: str):
+        with self._mutex:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _prepare_normal_file(self, url, dst):
+        new_path = self._file_path(FILENAME_REGEX.search(url), dst)
         lock_hash, unchanged = self._file_exists_unchanged(url, new_path)
         if unchanged:
             self._lock(url, *self._current_lock[url])
-            self._skipped += 1
+            self._lock_validators(url, self._current_validators.get(url))
+            self._count('_skipped')
             progress_logger.debug('%s already exists unchanged, not downloading', url)
             return
 
         progress_logger.info('downloading: %s ➤ %s...', url, new_path.relative_to(self.download_root))
-        content = self._get_url(url)
-        remote_hash = self._data_hash(content)
-        if lock_hash and remote_hash != lock_hash:
+        return partial(self._save_normal_file, url, new_path, lock_hash)
+
+    def _save_normal_file(self, url, new_path: Path, lock_hash, download: DownloadedFile):
+        if lock_hash and download.hash != lock_hash:
             progress_logger.error('Security warning: hash of remote file %s has changed!', url)
             raise GrablibError('remote hash mismatch')
-        self._write(new_path, content, url)
-        self._downloaded += 1
+        self._place(download, [new_path])
+        self._lock(url, str(new_path.relative_to(self.download_root)), download.hash)
+        self._lock_validators(url, download.validators)
+        self._count('_downloaded')
 
     def _file_exists_unchanged(self, url, path: Path):
         name_hash = self._current_lock.get(url)
@@ -100,64 +1083,255 @@ class Downloader:
         file_hash = self._path_hash(path)
         return lock_hash, file_hash == lock_hash
 
-    def _process_zip(self, url, value):
+    def _prepare_zip(self, url, value):
         value_hash = self._data_hash(json.dumps(value, sort_keys=True).encode())
-        lock_hash, unchanged = self._zip_exists_unchanged(url, value_hash)
+        archive_hashes, unchanged = self._zip_exists_unchanged(url, value_hash)
         if unchanged:
             [self._lock(url, name, lock_hash) for name, lock_hash in self._current_lock[url]]
-            self._skipped += 1
+            self._lock_validators(url, self._current_validators.get(url))
+            self._count('_skipped')
             progress_logger.debug('%s already exists unchanged, not downloading', url)
             return
-        progress_logger.info('downloading zip: %s...', url)
-        content = self._get_url(url)
-        remote_hash = self._data_hash(content)
+        progress_logger.info('downloading archive: %s...', url)
+        return partial(self._save_zip, url, value, value_hash, archive_hashes)
+
+    def _save_zip(self, url, value, value_hash, archive_hashes: dict, download):
+        """
+        :param archive_hashes: hashes of the archive from the lock file, keyed by ZIP_RAW_REF and ZIP_INDEX_REF
+        :param download: either the downloaded archive or a RemoteZip
+        """
+        if isinstance(download, RemoteZip):
+            ref, remote_hash, zip_file = ZIP_INDEX_REF, download.index_hash, download
+        else:
+            ref, remote_hash, zip_file = ZIP_RAW_REF, download.hash, str(download.path)
+            if ZIP_INDEX_REF in archive_hashes and ZIP_RAW_REF not in archive_hashes:
+                # archive was locked after a partial download, compare central directories instead
+                with download.path.open('rb') as f:
+                    ref, remote_hash = ZIP_INDEX_REF, self._zip_index_hash(f)
+        lock_hash = archive_hashes.get(ref)
         if lock_hash and remote_hash != lock_hash:
             progress_logger.error('Security warning: hash of remote file %s has changed!', url)
             raise GrablibError('remote hash mismatch')
         self._lock(url, ZIP_VALUE_REF, value_hash)
-        self._lock(url, ZIP_RAW_REF, remote_hash)
-        zcopied = self._extract_zip(url, content, value)
-        progress_logger.info('  %d files copied from zip archive', zcopied)
-        self._downloaded += 1
+        self._lock(url, ref, remote_hash)
+        self._lock_validators(url, download.validators)
+        # the central directory only pins members by CRC32, so also check members against their locked md5
+        locked_hashes = self._locked_member_hashes(url, value_hash) if ref == ZIP_INDEX_REF else None
+        if isinstance(download, RemoteZip) or not self._is_tarball(download.path):
+            zcopied = self._extract_zip(url, zip_file, value, locked_hashes)
+        else:
+            zcopied = self._extract_tar(url, download.path, value)
+        progress_logger.info('  %d files copied from archive', zcopied)
+        if isinstance(download, RemoteZip):
+            progress_logger.info('  %s of %s archive downloaded', fmt_size(download.fetched), fmt_size(download.size))
+        self._count('_downloaded')
+
+    @staticmethod
+    def _is_tarball(path: Path) -> bool:
+        return not zipfile.is_zipfile(str(path)) and tarfile.is_tarfile(str(path))
+
+    def _locked_member_hashes(self, url, value_hash) -> dict:
+        """
+        Find the hashes of files extracted from url in the lock, empty if the extraction rules have changed since
+        the same destination could then legitimately come from a different member.
+        """
+        name_hashes = dict(self._current_lock.get(url) or [])
+        if name_hashes.get(ZIP_VALUE_REF) != value_hash:
+            return {}
+        return {name: hash_ for name, hash_ in name_hashes.items() if not name.startswith(':')}
 
-    def _extract_zip(self, url, content, value):
-        zipinmemory = IO(content)
+    def _extract_zip(self, url, zip_file, value, locked_hashes: dict=None):
+        """
+        :param zip_file: path of the archive or a file object
+        :param locked_hashes: hashes from the lock which extracted files must match, keyed by relative path
+        """
         zcopied = 0
-        with zipfile.ZipFile(zipinmemory) as zipf:
+        with zipfile.ZipFile(zip_file) as zipf:
             progress_logger.debug('%d files in zip archive', len(zipf.namelist()))
+            routes = ZipRoutes(value)
 
-            for filepath in zipf.namelist():
-                if filepath.endswith('/'):
+            for info in zipf.infolist():
+                if info.filename.endswith('/'):
                     continue
-                regex_pattern, targets = None, None
-                for r, t in value.items():
-                    if re.match(r, filepath):
-                        regex_pattern, targets = r, t
-                        break
-                if regex_pattern is None:
-                    progress_logger.debug('"%s" no target found', filepath)
-                elif targets is None:
-                    progress_logger.debug('"%s" skipping (regex: "%s")', filepath, regex_pattern)
-                else:
-                    if isinstance(targets, str):
-                        targets = [targets]
-                    for target in targets:
-                        new_path = self._file_path(filepath, target, regex=regex_pattern)
-                        progress_logger.debug('"%s" ➤ "%s" (regex: "%s")',
-                                              filepath, new_path.relative_to(self.download_root), regex_pattern)
-                        self._write(new_path, zipf.read(filepath), url)
-                        zcopied += 1
+                new_paths = self._member_paths(routes, info.filename)
+                if new_paths:
+                    zcopied += self._extract_member(zipf, info, new_paths, url, locked_hashes)
         return zcopied
 
+    def _extract_tar(self, url, tar_path: Path, value):
+        """
+        Read the tarball as a stream so each member is decompressed straight to disk in one pass, whatever the
+        compression used.
+        """
+        tcopied = 0
+        routes = ZipRoutes(value)
+        with tarfile.open(str(tar_path), mode='r|*') as tarf:
+            for info in tarf:
+                # directories, links and devices are never extracted
+                if not info.isfile():
+                    continue
+                new_paths = self._member_paths(routes, info.name)
+                if new_paths:
+                    tcopied += self._write_member(tarf.extractfile(info), new_paths, url, size=info.size)
+        return tcopied
+
+    def _member_paths(self, routes: ZipRoutes, filepath: str) -> list:
+        """
+        Find the paths a member of an archive should be extracted to, empty if it shouldn't be extracted.
+        """
+        route = routes.route(filepath)
+        if route is None:
+            progress_logger.debug('"%s" no target found', filepath)
+            return []
+        regex_pattern, targets, m = route
+        if targets is None:
+            progress_logger.debug('"%s" skipping (regex: "%s")', filepath, regex_pattern)
+            return []
+        new_paths = []
+        for target in targets:
+            new_path = self._file_path(m, target)
+            progress_logger.debug('"%s" ➤ "%s" (regex: "%s")',
+                                  filepath, new_path.relative_to(self.download_root), regex_pattern)
+            new_paths.append(new_path)
+        return new_paths
+
+    def _extract_member(self, zipf: zipfile.ZipFile, info: zipfile.ZipInfo, new_paths: list, url: str,
+                        locked_hashes: dict=None) -> int:
+        """
+        Extract a member of the zip, paths which already have the same size and CRC32 as the member are left
+        untouched so their mtimes don't change.
+        """
+        changed_paths = []
+        for new_path in new_paths:
+            if self._member_unchanged(new_path, info):
+                self._lock_unchanged_member(url, new_path)
+            else:
+                changed_paths.append(new_path)
+        if not changed_paths:
+            return 0
+        with zipf.open(info) as f:
+            return self._write_member(f, changed_paths, url, crc=info.CRC, locked_hashes=locked_hashes)
+
+    def _write_member(self, f, new_paths: list, url: str, *, crc: int=None, size: int=None,
+                      locked_hashes: dict=None) -> int:
+        """
+        Decompress a member of an archive once, streaming it to a temporary file, then put it in place at each
+        of new_paths.
+
+        :param size: size of the member if paths haven't already been checked, paths with that size are only
+          rewritten if their hash differs from the member's
+        :param locked_hashes: hashes from the lock the member must match at each of new_paths
+        """
+        with DownloadedFile(self.download_root) as extracted:
+            extracted.write_from(f)
+            extracted.close()
+            for new_path in new_paths:
+                name = str(new_path.relative_to(self.download_root))
+                lock_hash = locked_hashes and locked_hashes.get(name)
+                if lock_hash and lock_hash != extracted.hash:
+                    progress_logger.error('Security warning: hash of "%s" extracted from %s has changed!', name, url)
+                    raise GrablibError('remote hash mismatch')
+            changed_paths = []
+            for new_path in new_paths:
+                if size is not None and self._same_content(new_path, size, extracted.hash):
+                    self._lock_unchanged_member(url, new_path)
+                else:
+                    changed_paths.append(new_path)
+            if not changed_paths:
+                return 0
+            self._place(extracted, changed_paths, crc)
+        for new_path in changed_paths:
+            self._lock(url, str(new_path.relative_to(self.download_root)), extracted.hash)
+        return len(changed_paths)
+
+    def _place(self, download: DownloadedFile, new_paths: list, crc: int=None):
+        """
+        Put a temporary file in place, it's moved to the first of new_paths and copied to the others.
+
+        In dedup mode paths are linked to an existing file with the same content instead where possible.
+        """
+        first_path, *other_paths = new_paths
+        if not self._link_duplicate(download.hash, first_path):
+            download.move_to(first_path)
+        self._record_hash(first_path, download.hash, crc)
+        for new_path in other_paths:
+            if not self._link_duplicate(download.hash, new_path):
+                self._copy_to(first_path, new_path)
+            self._record_hash(new_path, download.hash, crc)
+
+    @staticmethod
+    def _copy_to(src: Path, new_path: Path):
+        """
+        Copy src to a temporary file and move it to new_path, existing files are replaced rather than written to
+        since they may be hard linked to other files by dedup or hardlink_local.
+        """
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = new_path.parent / '.grablib-{}.tmp'.format(hashlib.md5(str(new_path).encode()).hexdigest())
+        try:
+            # left behind if a previous run was killed
+            tmp_path.exists() and tmp_path.unlink()
+            clone_file(src, tmp_path)
+            os.replace(str(tmp_path), str(new_path))
+        except BaseException:
+            if tmp_path.exists():
+                tmp_path.unlink()
+            raise
+
+    def _link_duplicate(self, hash_: str, new_path: Path) -> bool:
+        """
+        If dedup is enabled and a file in download_root already has the content hash_, replace new_path with a
+        hard link to it, or a reflink if that's not possible.
+
+        :return: whether new_path was linked
+        """
+        existing = self._dedup and self._dedup_index.get(hash_)
+        if not existing or existing == new_path or self._path_hash(existing) != hash_:
+            return False
+        new_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = new_path.parent / '.grablib-{}.tmp'.format(hashlib.md5(str(new_path).encode()).hexdigest())
+        try:
+            method = clone_file(existing, tmp_path, hardlink=True, copy=False)
+            if not method:
+                # copying the existing file would be more work than moving the new one into place
+                progress_logger.debug('unable to link "%s" to "%s"', new_path, existing)
+                return False
+            os.replace(str(tmp_path), str(new_path))
+        except OSError as e:
+            progress_logger.warning('unable to link "%s" to "%s": %s', new_path, existing, e)
+            if tmp_path.exists():
+                tmp_path.unlink()
+            return False
+        progress_logger.debug('"%s" %s to "%s"', new_path.relative_to(self.download_root), method,
+                              existing.relative_to(self.download_root))
+        return True
+
+    def _lock_unchanged_member(self, url, path: Path):
+        progress_logger.debug('"%s" unchanged, not rewriting', path.relative_to(self.download_root))
+        self._lock(url, str(path.relative_to(self.download_root)), self._path_hash(path))
+
+    def _member_unchanged(self, path: Path, info: zipfile.ZipInfo) -> bool:
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return False
+        return size == info.file_size and self._path_crc(path) == info.CRC
+
+    def _same_content(self, path: Path, size: int, hash_: str) -> bool:
+        try:
+            file_size = path.stat().st_size
+        except FileNotFoundError:
+            return False
+        return file_size == size and self._path_hash(path) == hash_
+
     def _zip_exists_unchanged(self, url, value_hash):
         name_hashes = self._current_lock.get(url)
-        zip_hash = None
+        archive_hashes = {}
         if name_hashes is None:
-            return zip_hash, False
+            return archive_hashes, False
         found_change = False
         for name, lock_hash in name_hashes:
-            if name == ZIP_RAW_REF:
-                zip_hash = lock_hash
+            if name in ARCHIVE_REFS:
+                archive_hashes[name] = lock_hash
                 continue
             if name == ZIP_VALUE_REF:
                 file_hash = value_hash
@@ -165,7 +1339,7 @@ class Downloader:
                 file_hash = self._path_hash(self.download_root.joinpath(name))
             if file_hash != lock_hash:
                 found_change = True
-        return zip_hash, not found_change and zip_hash is not None
+        return archive_hashes, not found_change and bool(archive_hashes)
 
     def _delete_stale(self):
         """
@@ -179,6 +1353,7 @@ class Downloader:
             if current_hash == hash_:
                 progress_logger.info('deleting: %s which is stale...', name)
                 path.unlink()
+                self._new_stat_cache.pop(str(path), None)
                 self._stale_deleted += 1
                 while True:
                     path = path.parent
@@ -192,11 +1367,10 @@ class Downloader:
                                       'Please check and delete the file manually.', name)
                 raise GrablibError('stale file modified')
 
-    def _file_path(self, src_path, dest, regex):
+    def _file_path(self, m, dest):
         """
-        check src_path complies with regex and generate new filename
+        generate new filename from dest using the groups of a regex match on the source path
         """
-        m = re.search(regex, src_path)
         if dest.endswith('/') or dest == '':
             dest += '{filename}'
         names = m.groupdict()
@@ -214,51 +1388,286 @@ class Downloader:
         return new_path
 
     def _setup_url(self, url_base):
+        # aliases with mirrors are replaced with the first mirror so lock files don't depend on which is fastest
         for name, value in self._aliases.items():
             url_base = url_base.replace(name, value)
         return url_base
 
-    def _get_url(self, url):
+    def _get_url(self, url) -> DownloadedFile:
+        """
+        Download url, if it's under an alias with mirrors they're tried fastest first until one succeeds.
+        """
+        *fallbacks, last = self._sources(url)
+        for source in fallbacks:
+            try:
+                return self._get_source(url, source)
+            except GrablibError:
+                progress_logger.warning('unable to download %s, trying the next mirror', source)
+        return self._get_source(url, last)
+
+    def _get_source(self, url, source) -> DownloadedFile:
+        """
+        Stream source to a temporary file in download_root, if a previous download of source failed part way
+        through it's resumed.
+
+        :param url: url as it appears in the lock file
+        :param source: url to download, either url itself or the same file on a mirror
+        """
+        if self._local_path(source):
+            return self._get_file(source)
+        with self._host_semaphore(urlsplit(source).netloc):
+            return self._stream_source(url, source)
+
+    def _stream_source(self, url, source) -> DownloadedFile:
+        reuse_path, headers = self._conditional_request(url)
+        download = PartialDownload(self.download_root, source, resume=not reuse_path)
         try:
-            r = self._session.get(url)
+            r = self._session.get(source, headers=dict(headers, **download.range_headers()), stream=True)
+            if r.status_code == 304 and reuse_path:
+                download.delete()
+                return self._not_modified(url, reuse_path, r.headers)
+            if not self._start_download(source, download, r.status_code, r.headers):
+                r = self._session.get(source, headers=headers, stream=True)
+                self._start_download(source, download, r.status_code, r.headers)
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                download.write(chunk)
+                self._rate_limiter and time.sleep(self._rate_limiter.reserve(len(chunk)))
+                self._check_deadline()
         except RequestException as e:
+            download.abort()
             progress_logger.error('Problem occurred during download: %s: %s', e.__class__.__name__, e)
             raise GrablibError('request error') from e
-        else:
-            if r.status_code != 200:
-                progress_logger.error('Wrong status code: %d', r.status_code)
-                raise GrablibError('Wrong status code')
-            return r.content
+        except BaseException:
+            download.delete()
+            raise
+        download.close()
+        download.validators = self._response_validators(r.headers)
+        self._add_location(url, source, r.url if r.history else None, download)
+        return download
 
-    def _write(self, new_path: Path, data: bytes, url: str):
-        new_path.parent.mkdir(parents=True, exist_ok=True)
-        new_path.write_bytes(data)
-        h = self._path_hash(new_path)
-        self._lock(url, str(new_path.relative_to(self.download_root)), h)
+    def _range_request(self, url, headers: dict) -> Tuple[int, dict, bytes]:
+        """
+        Make a Range request for part of a remote archive, limited by host_concurrency, download_rate_limit and
+        download_deadline the same as full downloads.
+
+        :return: status code, headers and content of the response, content is only read from 206 responses
+        """
+        with self._host_semaphore(urlsplit(url).netloc):
+            try:
+                r = self._session.get(url, headers=headers, stream=True)
+                if r.status_code != 206:
+                    r.close()
+                    return r.status_code, r.headers, b''
+                content = bytearray()
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    content += chunk
+                    self._rate_limiter and time.sleep(self._rate_limiter.reserve(len(chunk)))
+                    self._check_deadline()
+            except RequestException as e:
+                progress_logger.error('Problem occurred during download: %s: %s', e.__class__.__name__, e)
+                raise GrablibError('request error') from e
+        return r.status_code, r.headers, bytes(content)
+
+    def _get_file(self, source) -> DownloadedFile:
+        """
+        Copy a local file or a file from a local mirror to a temporary file in download_root.
+        """
+        path = self._local_path(source)
+        hash_ = path.is_file() and self._path_hash(path)
+        if not hash_:
+            progress_logger.error('Local file %s not found', path)
+            raise GrablibError('file not found')
+        download = LocalFile(self.download_root, path, hash_, hardlink=self._hardlink_local)
+        progress_logger.debug('%s copied using %s', path, download.method)
+        return download
+
+    def _sources(self, url) -> list:
+        """
+        Find the urls to try when downloading url in order, the location url was last redirected to comes first
+        so the redirect doesn't need to be followed again.
+        """
+        sources = self._mirror_urls(url)
+        location = self._current_validators.get(url, {}).get(LOCATION_REF)
+        if location:
+            sources = [location] + [s for s in sources if s != location]
+        return sources
+
+    def _add_location(self, url, source, final_url, download: DownloadedFile):
+        """
+        Save where the request for source ended up after redirects, if the location from the lock was used
+        successfully it's kept.
+
+        :param final_url: url of the response if the request was redirected
+        """
+        if final_url:
+            download.validators[LOCATION_REF] = final_url
+        elif source == self._current_validators.get(url, {}).get(LOCATION_REF):
+            download.validators[LOCATION_REF] = source
+
+    def _mirror_urls(self, url) -> list:
+        """
+        Find the urls url can be downloaded from, fastest first.
+        """
+        for base, mirrors in self._mirrors.items():
+            if url.startswith(base):
+                return [mirror + url[len(base):] for mirror in self._ordered_mirrors(base)]
+        return [url]
+
+    def _ordered_mirrors(self, base) -> list:
+        """
+        Find the mirrors of an alias fastest first, they're only probed the first time a url under the alias
+        needs downloading so runs where nothing has changed make no requests.
+        """
+        with self._mirror_mutex:
+            order = self._mirror_order.get(base)
+            if order is None:
+                order = self._mirror_order[base] = self._probe_mirrors(base)
+            return order
+
+    def _probe_mirrors(self, base) -> list:
+        """
+        Measure the latency of the mirrors of an alias concurrently.
+
+        :return: mirrors fastest first with mirrors which couldn't be reached last
+        """
+        mirrors = self._mirrors[base]
+        with requests.Session() as session, ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+            latencies = dict(zip(mirrors, executor.map(partial(self._probe_mirror, session), mirrors)))
+        order = sorted(enumerate(mirrors), key=lambda v: (latencies[v[1]] is None, latencies[v[1]] or 0, v[0]))
+        order = [mirror for _, mirror in order]
+        progress_logger.debug('mirrors for %s: %s', base, ', '.join(
+            '{} ({})'.format(m, 'unreachable' if latencies[m] is None else '{:0.0f}ms'.format(latencies[m] * 1000))
+            for m in order
+        ))
+        return order
+
+    @staticmethod
+    def _probe_mirror(session: requests.Session, mirror: str) -> Optional[float]:
+        """
+        :return: time taken in seconds for the mirror to respond or None if it's unreachable or unhealthy
+        """
+        if mirror.startswith('file://'):
+            return 0 if Path(unquote(urlsplit(mirror).path)).is_dir() else None
+        start = time.monotonic()
+        try:
+            r = session.head(mirror, timeout=MIRROR_PROBE_TIMEOUT, allow_redirects=False)
+        except RequestException:
+            return
+        if r.status_code < 500:
+            return time.monotonic() - start
+
+    def _host_semaphore(self, host) -> threading.Semaphore:
+        with self._mutex:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = self._host_semaphores[host] = threading.Semaphore(self._host_concurrency)
+            return semaphore
+
+    def _check_deadline(self):
+        """
+        Read timeouts only apply to each chunk so a slow download is stopped here once the deadline passes.
+        """
+        if self._deadline is not None and time.monotonic() > self._deadline:
+            raise DeadlineExceeded('download deadline exceeded')
+
+    def _start_download(self, url, download: PartialDownload, status: int, headers) -> bool:
+        """
+        Check the status of a response before its body is written to download.
+
+        :return: False if download was partial but couldn't be resumed so the request should be repeated
+          without a Range header
+        """
+        if status == 206 and download.resumes_at(headers):
+            progress_logger.info('resuming download of %s from %s', url, fmt_size(download.size))
+            return True
+        elif status == 200:
+            download.restart(headers)
+            return True
+        elif download.size and status in {206, 416}:
+            progress_logger.warning('unable to resume download of %s, restarting', url)
+            download.restart()
+            return False
+        progress_logger.error('Wrong status code: %d', status)
+        raise GrablibError('Wrong status code')
 
     def _lock(self, url: str, name: str, hash_: str):
         """
         Add details of the files downloaded to _new_lock so they can be saved to the lock file.
         Also remove path from _stale_files, whatever remains at the end therefore is stale and can be deleted.
         """
-        self._new_lock.append({
-            'url': url,
-            'name': name,
-            'hash': hash_,
-        })
-        self._stale_files.pop(name, None)
+        with self._mutex:
+            self._new_lock.append({
+                'url': url,
+                'name': name,
+                'hash': hash_,
+            })
+            self._stale_files.pop(name, None)
 
     def _path_hash(self, path: Path):
-        if not path.exists():
+        """
+        Find the md5 hash of path, the file is only read if its stat signature has changed since it was last
+        hashed or if in paranoid mode.
+        """
+        return self._cached_digest(path, 0, self._file_hash)
+
+    def _path_crc(self, path: Path):
+        """
+        Find the CRC32 of path, cached the same way as _path_hash.
+        """
+        return self._cached_digest(path, 1, self._file_crc)
+
+    def _cached_digest(self, path: Path, index: int, calculate):
+        """
+        Stat cache entries are lists of [size, mtime_ns, inode, md5, crc32], digests are None until calculated.
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
             return
-        data = path.read_bytes()
-        return self._data_hash(data)
+        signature = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        key = str(path)
+        entry = self._new_stat_cache.get(key) or self._old_stat_cache.get(key)
+        if not entry or len(entry) != 5 or entry[:3] != signature:
+            entry = signature + [None, None]
+        if self._paranoid or entry[3 + index] is None:
+            entry = list(entry)
+            entry[3 + index] = calculate(path)
+        self._new_stat_cache[key] = entry
+        return entry[3 + index]
+
+    def _record_hash(self, path: Path, hash_: str, crc: int=None):
+        """
+        Save the hash of a file which has just been written so it doesn't need to be hashed on the next run.
+        """
+        stat = path.stat()
+        self._new_stat_cache[str(path)] = [stat.st_size, stat.st_mtime_ns, stat.st_ino, hash_, crc]
+        if self._dedup:
+            self._dedup_index.setdefault(hash_, path)
+
+    def _hash_if_exists(self, path: Path):
+        return self._file_hash(path) if path.exists() else None
+
+    @staticmethod
+    def _file_hash(path: Path):
+        md5 = hashlib.md5()
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+        return md5.hexdigest()
+
+    @staticmethod
+    def _file_crc(path: Path):
+        crc = 0
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                crc = zlib.crc32(chunk, crc)
+        return crc
 
     def _data_hash(self, data: bytes):
         return hashlib.md5(data).hexdigest()
 
     def _read_lock(self) -> tuple:
-        current_lock, stale_files = {}, {}
+        current_lock, validators, stale_files = {}, {}, {}
         comment = re.compile('^ *#')
         if self._lock_file and self._lock_file.exists():
             with self._lock_file.open() as f:
@@ -266,6 +1675,10 @@ class Downloader:
                     if comment.match(line):
                         continue
                     hash_, url, name = line.strip('\n').split(' ')
+                    if name in VALIDATORS or name == LOCATION_REF:
+                        # validators and locations aren't files so are kept separately
+                        validators.setdefault(url, {})[name] = unquote(hash_)
+                        continue
                     v = name, hash_
                     existing_v = current_lock.get(url)
                     if existing_v is None:
@@ -283,7 +1696,7 @@ class Downloader:
             if isinstance(name_hashes, tuple):
                 name_hashes = [name_hashes]
             stale_files.update({name: hash_ for name, hash_ in name_hashes})
-        return current_lock, stale_files
+        return current_lock, validators, stale_files
 
     def _save_lock(self):
         if self._lock_file is None:
@@ -300,3 +1713,150 @@ class Downloader:
             text += '\n'.join('{} {} {}'.format(h, STALE, n) for n, h in sorted(self._stale_files.items()))
         text += '\n'
         self._lock_file.write_text(text)
+
+
+class AsyncDownloader(Downloader):
+    """
+    asyncio variant of Downloader, all urls are downloaded concurrently on one event loop using aiohttp.
+
+    Usage: "await AsyncDownloader(**config)()", the lock file and downloaded files are identical to Downloader.
+
+    Hashing, extraction and copying files are run in the loop's default executor so they don't block other
+    tasks on the loop. zip_ranges isn't supported, archives are always downloaded in full. Retries use
+    download_retries and download_backoff like Downloader but are implemented here since aiohttp has no
+    equivalent of urllib3's Retry.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._aio_session = None
+
+    async def __call__(self):
+        aiohttp = self.get_aiohttp()
+        entries = await self._run(self._start)
+        connect_timeout, read_timeout = self._timeout if isinstance(self._timeout, tuple) else (self._timeout,) * 2
+        timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        async with aiohttp.ClientSession(timeout=timeout) as self._aio_session:
+            tasks = [asyncio.ensure_future(self._process_entry(url, value)) for url, value in entries]
+            try:
+                # awaiting in order means errors are raised in the order the entries are defined
+                for task in tasks:
+                    await task
+            except GrablibError:
+                for task in tasks:
+                    task.cancel()
+                raise
+        await self._run(self._finish)
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        """
+        Run a blocking function in the default executor of the current loop.
+        """
+        return await asyncio.get_event_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+    async def _process_entry(self, url, value):
+        with self._entry_errors(url, value):
+            save = await self._run(self._prepare_entry, url, value)
+            if save:
+                download = await self._run(self._from_cache, url, value)
+                if not download:
+                    download = await self._run(self._to_cache, url, value, await self._get_url(url))
+                with download:
+                    await self._run(save, download)
+
+    async def _get_url(self, url):
+        # finding sources may probe mirrors
+        *fallbacks, last = await self._run(self._sources, url)
+        for source in fallbacks:
+            try:
+                return await self._get_source(url, source)
+            except GrablibError:
+                progress_logger.warning('unable to download %s, trying the next mirror', source)
+        return await self._get_source(url, last)
+
+    async def _get_source(self, url, source):
+        if self._local_path(source):
+            return await self._run(self._get_file, source)
+        aiohttp = self.get_aiohttp()
+        host = urlsplit(source).netloc
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._host_semaphores[host] = asyncio.Semaphore(self._host_concurrency)
+        reuse_path, headers = await self._run(self._conditional_request, url)
+        async with semaphore:
+            # resuming hashes the existing partial download which could be large
+            download = await self._run(PartialDownload, self.download_root, source, resume=not reuse_path)
+            try:
+                result = await self._stream_with_retries(source, download, headers, reuse_path)
+            except (aiohttp.ClientError, asyncio.TimeoutError, DeadlineExceeded) as e:
+                download.abort()
+                progress_logger.error('Problem occurred during download: %s: %s', e.__class__.__name__, e)
+                raise GrablibError('request error') from e
+            except BaseException:
+                download.delete()
+                raise
+            if result is None:
+                download.delete()
+                return await self._run(self._not_modified, url, reuse_path, {})
+            download.close()
+            download.validators, final_url = result
+            self._add_location(url, source, final_url, download)
+            return download
+
+    async def _stream_with_retries(self, url, download: PartialDownload, headers: dict, reuse_path: Optional[Path]):
+        """
+        Call _stream_url retrying connection errors, timeouts and responses with a status in RETRY_STATUSES,
+        the nth retry waits download_backoff * 2 ^ (n - 1) seconds and resumes any partial download.
+        """
+        aiohttp = self.get_aiohttp()
+        for attempt in range(self._retries + 1):
+            if attempt:
+                delay = self._backoff * 2 ** (attempt - 1)
+                progress_logger.warning('retrying %s in %0.1fs', url, delay)
+                await asyncio.sleep(delay)
+            last_attempt = attempt == self._retries
+            try:
+                return await self._stream_url(url, download, headers, reuse_path, retry_status=not last_attempt)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError, RetryStatus):
+                if last_attempt:
+                    raise
+
+    async def _stream_url(self, url, download: PartialDownload, headers: dict, reuse_path: Optional[Path], *,
+                          retry_status: bool=False):
+        """
+        Write the body of url to download, returns the validators from the response and the url it was
+        redirected to or None if the response was "304 Not Modified".
+
+        :param retry_status: whether to raise RetryStatus if the response has a status in RETRY_STATUSES
+        """
+        self._check_deadline()
+        async with self._aio_session.get(url, headers=dict(headers, **download.range_headers())) as r:
+            if r.status == 304 and reuse_path:
+                return
+            if retry_status and r.status in RETRY_STATUSES:
+                raise RetryStatus(r.status)
+            if self._start_download(url, download, r.status, r.headers):
+                return await self._write_response(r, download)
+        async with self._aio_session.get(url, headers=headers) as r:
+            self._start_download(url, download, r.status, r.headers)
+            return await self._write_response(r, download)
+
+    async def _write_response(self, r, download: PartialDownload) -> tuple:
+        async for chunk in r.content.iter_chunked(CHUNK_SIZE):
+            download.write(chunk)
+            if self._rate_limiter:
+                await asyncio.sleep(self._rate_limiter.reserve(len(chunk)))
+            self._check_deadline()
+        return self._response_validators(r.headers), str(r.url) if r.history else None
+
+    @staticmethod
+    def get_aiohttp():
+        try:
+            import aiohttp
+        except ImportError as e:
+            main_logger.error('ImportError importing aiohttp: %s', e)
+            raise GrablibError(
+                'Error importing aiohttp. Async requirements probably not installed, run `pip install grablib[async]`'
+            ) from e
+        return aiohttp
@@ -8,19 +8,27 @@ from yaml.scanner import MarkedYAMLError
 
 from .build import Builder
 from .common import GrablibError, main_logger
-from .download import Downloader
+from .download import AsyncDownloader, Downloader
 
 STD_FILE_NAMES = [re.compile('grablib\.ya?ml'), re.compile('grablib\.json')]
 
 
 class Grab:
-    def __init__(self, config_file: str=None, *, download_root: str=None, debug=None):
+    def __init__(self, config_file: str=None, *,
+                 download_root: str=None,
+                 debug=None,
+                 download_workers: int=None,
+                 build_workers: int=None,
+                 paranoid=None):
         """
         Process a file or json string defining files to download and what to do with them.
 
         :param config_file: relative path to file defining what to download
         :param download_root: root_directory to download to
         :param debug: whether to run in debug mode
+        :param download_workers: number of files to download concurrently, overrides the config value
+        :param build_workers: number of processes to minify javascript with, overrides the config value
+        :param paranoid: whether to re-hash all existing files rather than trusting their size and mtime
         """
         if config_file:
             config_path = Path(config_file).resolve()
@@ -37,6 +45,12 @@ class Grab:
             self.config_data['download_root'] = download_root
         if debug is not None:
             self.config_data['debug'] = debug
+        if download_workers is not None:
+            self.config_data['download_workers'] = download_workers
+        if build_workers is not None:
+            self.config_data['build_workers'] = build_workers
+        if paranoid is not None:
+            self.config_data['paranoid'] = paranoid
 
     def download(self):
         if 'download' not in self.config_data:
@@ -45,6 +59,23 @@ class Grab:
         download = Downloader(**self.config_data)
         download()
 
+    def verify(self):
+        if 'download' not in self.config_data:
+            main_logger.warning('verify called with no "download" info available')
+            return
+        download = Downloader(**self.config_data)
+        download.verify()
+
+    async def download_async(self):
+        """
+        Equivalent of download() for use inside an asyncio event loop, requires aiohttp.
+        """
+        if 'download' not in self.config_data:
+            main_logger.warning('download called with no "download" info available')
+            return
+        download = AsyncDownloader(**self.config_data)
+        await download()
+
     def build(self):
         if 'build' not in self.config_data:
             main_logger.warning('build called with no "build" info available')
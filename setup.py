@@ -47,5 +47,8 @@ setup(
             'jsmin>=2.2.1',
             'libsass>=0.12',
         ],
+        'async': [
+            'aiohttp>=3.3',
+        ],
     }
 )
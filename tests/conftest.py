@@ -0,0 +1,12 @@
+import tempfile
+
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def private_tempdir(tmpdir_factory, monkeypatch):
+    """
+    Keep caches grablib saves in the system temp directory or the user's cache directory out of the real ones.
+    """
+    monkeypatch.setattr(tempfile, 'tempdir', str(tmpdir_factory.mktemp('system_tmp')))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir_factory.mktemp('user_cache')))
@@ -1,11 +1,13 @@
 import builtins
+import tempfile
+from pathlib import Path
 
 import pytest
 from pytest_toolbox import gettree, mktree
 
 from grablib import Grab
-from grablib.build import fmt_size
-from grablib.common import GrablibError, setup_logging
+from grablib.build import Builder, ReplaceRules
+from grablib.common import GrablibError, fmt_size, setup_logging
 
 real_import = builtins.__import__
 
@@ -383,6 +385,18 @@ def test_sass_replace(tmpworkdir):
     } == gettree(tmpworkdir.join('built_at/css'))
 
 
+def test_replace_rules():
+    rules = ReplaceRules({'black': 'white', 'bl[ue]+': 'red', 'missing': 'x'})
+    assert rules
+    assert rules.apply('black blue black') == ('white red white', [
+        ('black', 'white', 2),
+        ('bl[ue]+', 'red', 1),
+        ('missing', 'x', 0),
+    ])
+    assert not ReplaceRules()
+    assert ReplaceRules(None).apply('foo') == ('foo', [])
+
+
 def test_sass_clever_import(tmpworkdir):
     mktree(tmpworkdir, {
         'grablib.yml': """
@@ -471,3 +485,277 @@ def test_sass_clever_import_node_modules(tmpworkdir):
 ])
 def test_fmt_size_large(value, result):
     assert fmt_size(value) == result
+
+
+def test_cat_incremental(tmpworkdir, mocker):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "foo.min.js":
+              - "./foo.js"
+            "bar.min.js":
+              - "./bar.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+        'bar.js': 'var v = "bar js";',
+    })
+    read_file = mocker.spy(Builder, '_read_file')
+    Grab().build()
+    assert read_file.call_count == 2
+    built = gettree(tmpworkdir.join('built_at'))
+
+    Grab().build()
+    assert read_file.call_count == 2
+    assert gettree(tmpworkdir.join('built_at')) == built
+
+    tmpworkdir.join('foo.js').write('var v = "changed";')
+    Grab().build()
+    assert read_file.call_count == 3
+    assert tmpworkdir.join('built_at/foo.min.js').read() == '/* === foo.js === */\nvar v="changed";\n'
+
+    # modified and missing dests are rebuilt
+    tmpworkdir.join('built_at/foo.min.js').write('modified')
+    tmpworkdir.join('built_at/bar.min.js').remove()
+    Grab().build()
+    assert read_file.call_count == 5
+    Grab(debug=True).build()
+    assert read_file.call_count == 7
+
+
+def test_cat_manifest_corrupt(tmpworkdir, mocker):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "foo.min.js":
+              - "./foo.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+    })
+    read_file = mocker.spy(Builder, '_read_file')
+    Grab().build()
+    manifest_file, = Path(tempfile.gettempdir()).glob('grablib_cat_manifest.*.json')
+
+    # an unreadable manifest, eg. from a build which was killed, means the bundle is rebuilt
+    for content in ('{"trunc', '[]', '{"%s": []}' % tmpworkdir.join('built_at/foo.min.js')):
+        manifest_file.write_text(content)
+        Grab().build()
+        assert tmpworkdir.join('built_at/foo.min.js').read() == '/* === foo.js === */\nvar v="foo js";\n'
+    assert read_file.call_count == 4
+    Grab().build()
+    assert read_file.call_count == 4
+
+
+def test_minify_cache(tmpworkdir, mocker):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        minify_cache: "minify_cache"
+        minify_cache_max_size: 40
+        build:
+          cat:
+            "a.min.js":
+              - "./foo.js"
+            "b.min.js":
+              - "./foo.js"
+              - "./bar.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+        'bar.js': 'var v = "bar js";',
+    })
+    from jsmin import jsmin
+    mock_jsmin = mocker.patch('jsmin.jsmin', side_effect=jsmin)
+    Grab().build()
+    # foo.js is only minified once despite being in both bundles
+    assert mock_jsmin.call_count == 2
+    assert tmpworkdir.join('built_at/b.min.js').read() == (
+        '/* === foo.js === */\nvar v="foo js";\n/* === bar.js === */\nvar v="bar js";\n'
+    )
+    cache_files = list(tmpworkdir.join('minify_cache').visit(lambda p: p.isfile()))
+    assert len(cache_files) == 2
+
+    tmpworkdir.join('built_at').remove()
+    Grab().build()
+    assert mock_jsmin.call_count == 2
+    assert tmpworkdir.join('built_at/a.min.js').read() == '/* === foo.js === */\nvar v="foo js";\n'
+
+    # entries beyond minify_cache_max_size are evicted
+    tmpworkdir.join('bar.js').write('var v = "bar js changed";')
+    Grab().build()
+    assert mock_jsmin.call_count == 3
+    cache_files = list(tmpworkdir.join('minify_cache').visit(lambda p: p.isfile()))
+    assert sum(p.size() for p in cache_files) <= 40
+
+
+def test_minify_cache_disabled(tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        minify_cache: false
+        build:
+          cat:
+            "foo.min.js":
+              - "./foo.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+    })
+    Grab().build()
+    assert tmpworkdir.join('built_at/foo.min.js').read() == '/* === foo.js === */\nvar v="foo js";\n'
+    assert not tmpworkdir.join('minify_cache').check()
+
+
+def test_cat_build_workers(tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        minify_cache: false
+        build:
+          cat:
+            "a.min.js":
+              - "./foo.js"
+              - "./bar.js"
+            "b.min.js":
+              - src: "./foo.js"
+                replace:
+                  "foo": "FOO"
+              - "./spam.min.js"
+            "c.css":
+              - "./styles.css"
+        """,
+        'foo.js': 'var v = "foo js";\n\n// comment\n',
+        'bar.js': 'function bar() {\n  return 1;\n}\n',
+        'spam.min.js': 'var v = "spam";',
+        'styles.css': 'a {\n  color: red;\n}\n',
+    })
+    Grab().build()
+    serial = gettree(tmpworkdir.join('built_at'))
+    tmpworkdir.join('built_at').remove()
+
+    Grab(build_workers=4).build()
+    assert gettree(tmpworkdir.join('built_at')) == serial
+    assert serial['b.min.js'] == '/* === foo.js === */\nvar v="FOO js";\n/* === spam.min.js === */\nvar v = "spam";\n'
+
+
+def test_cat_atomic_write(tmpworkdir, mocker):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "foo.min.js":
+              - "./foo.js"
+              - "./bar.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+        'bar.js': 'var v = "bar js";',
+        'built_at': {'foo.min.js': 'original'},
+    })
+    mocker.patch('grablib.build.Builder._read_file', side_effect=['var v="foo js";', OSError('read failed')])
+    with pytest.raises(OSError):
+        Grab().build()
+    # the old bundle is untouched and the temporary file is cleaned up
+    assert gettree(tmpworkdir.join('built_at')) == {'foo.min.js': 'original'}
+
+    mocker.stopall()
+    Grab().build()
+    assert gettree(tmpworkdir.join('built_at')) == {
+        'foo.min.js': '/* === foo.js === */\nvar v="foo js";\n/* === bar.js === */\nvar v="bar js";\n'
+    }
+    tmpworkdir.join('plain.txt').write('x')
+    assert tmpworkdir.join('built_at/foo.min.js').stat().mode == tmpworkdir.join('plain.txt').stat().mode
+
+
+def test_cat_empty_replace(tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "foo.min.js":
+              - src: "./foo.js"
+                replace: {}
+              - "./bar.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+        'bar.js': 'var v = "bar js";',
+    })
+    Grab().build()
+    assert tmpworkdir.join('built_at/foo.min.js').read() == (
+        '/* === foo.js === */\nvar v="foo js";\n/* === bar.js === */\nvar v="bar js";\n'
+    )
+
+
+def test_minify_cache_default_location(tmpworkdir, monkeypatch):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "foo.min.js":
+              - "./foo.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+    })
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpworkdir.join('cache')))
+    Grab().build()
+    cache_dir = tmpworkdir.join('cache/grablib/jsmin')
+    assert cache_dir.stat().mode & 0o777 == 0o700
+    assert len(list(cache_dir.visit(lambda p: p.isfile()))) == 1
+
+
+def test_minify_cache_unavailable(tmpworkdir, monkeypatch):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        build:
+          cat:
+            "foo.min.js":
+              - "./foo.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+    })
+    monkeypatch.setenv('XDG_CACHE_HOME', '/proc/nonexistent')
+    Grab().build()
+    assert tmpworkdir.join('built_at/foo.min.js').read() == '/* === foo.js === */\nvar v="foo js";\n'
+
+
+def test_minify_cache_lazy(tmpworkdir, monkeypatch):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        debug: true
+        build:
+          cat:
+            "foo.js":
+              - "./foo.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+    })
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpworkdir.join('cache')))
+    Grab().build()
+    assert tmpworkdir.join('built_at/foo.js').check()
+    # nothing was minified so the cache directory isn't created
+    assert not tmpworkdir.join('cache').check()
+
+
+def test_minify_cache_insecure_dir(tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        build_root: "built_at"
+        minify_cache: "shared"
+        build:
+          cat:
+            "foo.min.js":
+              - "./foo.js"
+        """,
+        'foo.js': 'var v = "foo js";',
+        'shared': {'.keep': ''},
+    })
+    tmpworkdir.join('shared').chmod(0o777)
+    Grab().build()
+    assert tmpworkdir.join('built_at/foo.min.js').read() == '/* === foo.js === */\nvar v="foo js";\n'
+    # the cache isn't used since other users could write to it
+    assert [p.basename for p in tmpworkdir.join('shared').listdir()] == ['.keep']
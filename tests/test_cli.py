@@ -9,7 +9,7 @@ def test_simple_wrong_path():
     runner = CliRunner()
     result = runner.invoke(cli, ['download', '-f', 'test_file'])
     assert result.exit_code == 2
-    assert result.output == ('Usage: cli [OPTIONS] [download / build]\n\n'
+    assert result.output == ('Usage: cli [OPTIONS] [download / build / verify]\n\n'
                              'Error: Invalid value for "-f" / "--config-file": Path "test_file" does not exist.\n')
 
 
@@ -57,6 +57,11 @@ def test_build_verbosity(tmpworkdir):
     assert result.exit_code == 0
     assert '1 files combined to form "libraries.js"' in result.output
     assert 'appending foo.js' not in result.output
+    # bundles are only rebuilt when their sources change
+    result = CliRunner().invoke(cli, ['build'])
+    assert result.exit_code == 0
+    assert 'sources of "libraries.js" unchanged, not rebuilding' in result.output
+    tmpworkdir.join('foo.js').write('var v = "changed";')
     result = CliRunner().invoke(cli, ['build', '-v'])
     assert result.exit_code == 0
     assert '1 files combined to form "libraries.js"' in result.output
@@ -71,3 +76,80 @@ def test_log_setup():
     assert log_config('INFO')['handlers']['default']['level'] == 'INFO'
     assert log_config(3)['handlers']['default']['level'] == 'DEBUG'
     assert log_config('DEBUG')['handlers']['default']['level'] == 'DEBUG'
+
+
+def test_download_jobs(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download:\n  'http://wherever.com/file.js': x"
+    })
+    mock_downloader = mocker.patch('grablib.grab.Downloader')
+    result = CliRunner().invoke(cli, ['download', '-j', '4'])
+    assert result.exit_code == 0
+    assert mock_downloader.call_args[1]['download_workers'] == 4
+
+
+def test_download_paranoid(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download:\n  'http://wherever.com/file.js': x"
+    })
+    mock_downloader = mocker.patch('grablib.grab.Downloader')
+    result = CliRunner().invoke(cli, ['download', '--paranoid'])
+    assert result.exit_code == 0
+    assert mock_downloader.call_args[1]['paranoid'] is True
+
+
+def test_verify(tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        download_root: droot
+        download:
+          'http://wherever.com/file.js': x
+          'http://wherever.com/file2.js': y
+          'https://any-old-url.com/test_assets.zip':
+            'test_assets/assets/(.+)': 'subdirectory/{filename}'
+        """,
+        '.grablib.lock': (
+            'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n'
+            'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file2.js y\n'
+            'b56e6adc64a2a57319285ae64e64d2ec https://any-old-url.com/test_assets.zip :zip-lookup\n'
+            '0d815adb49aeaa79990afa6387b36014 https://any-old-url.com/test_assets.zip :zip-raw\n'
+            '60b725f10c9c85c70d97880dfe8191b3 https://any-old-url.com/test_assets.zip subdirectory/a.txt\n'
+            '3b5d5c3712955042212316173ccf37be https://any-old-url.com/test_assets.zip subdirectory/b.txt\n'
+            '# stale\n'
+            'b5a3344a4b3651ebd60a1e15309d737c :stale old\n'
+        ),
+        'droot': {'x': 'response text', 'y': 'response text', 'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}},
+    })
+    result = CliRunner().invoke(cli, ['verify'])
+    assert result.exit_code == 0, result.output
+    assert '5 files checked, 0 missing, 0 modified, 0 stale' in result.output
+
+    tmpworkdir.join('droot/x').write('changed')
+    tmpworkdir.join('droot/old').write('response text')
+    tmpworkdir.join('droot/y').remove()
+    result = CliRunner().invoke(cli, ['verify'])
+    assert result.exit_code == 2
+    assert 'missing: y\n' in result.output
+    assert 'modified: x\n' in result.output
+    assert 'stale: old\n' in result.output
+    assert '5 files checked, 1 missing, 1 modified, 1 stale' in result.output
+    assert 'Error: verification failed' in result.output
+
+
+def test_verify_no_lock(tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download_root: droot\ndownload:\n  'http://wherever.com/file.js': x",
+    })
+    result = CliRunner().invoke(cli, ['verify'])
+    assert result.exit_code == 2
+    assert 'Error: lock file ".grablib.lock" not found, unable to verify' in result.output
+
+
+def test_build_jobs(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "build:\n  cat:\n    'foo.js': ['./foo.js']"
+    })
+    mock_builder = mocker.patch('grablib.grab.Builder')
+    result = CliRunner().invoke(cli, ['build', '-j', '4'])
+    assert result.exit_code == 0
+    assert mock_builder.call_args[1]['build_workers'] == 4
@@ -1,24 +1,90 @@
+import asyncio
+import hashlib
+import io
+import os
+import re
+import tarfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
 from pathlib import Path
 
 import pytest
-from pytest_toolbox import gettree, mktree
+import pytest_toolbox
+from pytest_toolbox import mktree
 from requests import HTTPError
+from requests.exceptions import ChunkedEncodingError
 
 from grablib import Grab
 from grablib.common import GrablibError
+from grablib.download import DeadlineExceeded, Downloader, PartialDownload, RateLimiter, ZipRoutes, clone_file
 
 FIXTURES = Path(__file__).resolve().parent / Path('fixtures')
 
 
+def gettree(lp, max_len=120):
+    """
+    pytest_toolbox.gettree without stat caches, their content depends on inodes and mtimes.
+    """
+    return strip_stat_caches(pytest_toolbox.gettree(lp, max_len=max_len))
+
+
+def strip_stat_caches(tree):
+    if isinstance(tree, dict):
+        return {k: strip_stat_caches(v) for k, v in tree.items() if not k.endswith('.stat-cache')}
+    return tree
+
+
 class MockResponse:
-    def __init__(self, *, status_code=200, content=b'response text', headers=None):
+    def __init__(self, *, status_code=200, content=b'response text', headers=None, url=None):
         self.status_code = status_code
         self.content = content
+        self.url = url
+        self.history = [MockResponse(status_code=301)] if url else []
         self.headers = headers or {
             'content-type': 'application/json',
             'server': 'Mock'
         }
 
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        pass
+
+
+class MockStreamReader:
+    def __init__(self, content):
+        self._chunks = [content]
+
+    def iter_chunked(self, n):
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._chunks:
+            raise StopAsyncIteration
+        return self._chunks.pop(0)
+
+
+class MockAsyncResponse:
+    def __init__(self, *, status=200, content=b'response text', headers=None, url=None):
+        self.status = status
+        self.url = url
+        self.history = [MockAsyncResponse(status=301)] if url else []
+        self.content = MockStreamReader(content)
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
 
 def request_fixture(url, **kwargs):
     filename = url.split('/')[-1]
@@ -26,6 +92,22 @@ def request_fixture(url, **kwargs):
     return MockResponse(content=p.read_bytes(), headers={'content-type': 'application/zip'})
 
 
+def range_response(content, headers=None):
+    m = re.match(r'bytes=(\d*)-(\d*)$', (headers or {}).get('Range', ''))
+    if not m:
+        return MockResponse(content=content)
+    if m.group(1):
+        start, stop = int(m.group(1)), min(int(m.group(2) or len(content) - 1) + 1, len(content))
+    else:
+        start, stop = max(len(content) - int(m.group(2)), 0), len(content)
+    content_range = 'bytes {}-{}/{}'.format(start, stop - 1, len(content))
+    return MockResponse(status_code=206, content=content[start:stop], headers={'Content-Range': content_range})
+
+
+def range_request_fixture(url, headers=None, **kwargs):
+    return range_response(request_fixture(url).content, headers)
+
+
 def test_simple(mocker, tmpworkdir):
     mktree(tmpworkdir, {
         'grablib.yml': "download:\n  'http://wherever.com/file.js': x"
@@ -90,6 +172,27 @@ def test_zip_double(mocker, tmpworkdir):
     assert gettree(tmpworkdir.join('test-download-dir')) == {'b.txt': 'b\n', 'a.txt': 'a\n', 'a_again.txt': 'a\n'}
 
 
+def test_zip_double_lock(mocker, tmpworkdir):
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    mktree(tmpworkdir, {
+        'grablib.yaml': """
+      'download':
+        'https://any-old-url.com/test_assets.zip':
+           'test_assets/assets/a.txt':
+             - a.txt
+             - again/a.txt
+    """})
+    Grab(download_root='test-download-dir').download()
+    assert gettree(tmpworkdir.join('test-download-dir')) == {'a.txt': 'a\n', 'again': {'a.txt': 'a\n'}}
+    lock = tmpworkdir.join('.grablib.lock').read().split('\n')
+    assert lock[2:] == [
+        '60b725f10c9c85c70d97880dfe8191b3 https://any-old-url.com/test_assets.zip a.txt',
+        '60b725f10c9c85c70d97880dfe8191b3 https://any-old-url.com/test_assets.zip again/a.txt',
+        '',
+    ]
+
+
 def test_zip_error(mocker, tmpworkdir):
     mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
     mock_requests_get.side_effect = request_fixture
@@ -124,7 +227,7 @@ def test_with_aliases(mocker, tmpworkdir):
     mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
     mock_requests_get.return_value = MockResponse()
     Grab().download()
-    mock_requests_get.assert_called_with('https://www.whatever.com/foo.js')
+    mock_requests_get.assert_called_with('https://www.whatever.com/foo.js', headers={}, stream=True)
     assert gettree(tmpworkdir.join('download_to')) == {
         'js': {
             'foo.js': 'response text'
@@ -162,6 +265,27 @@ def test_download_error(mocker, tmpworkdir):
     assert excinfo.value.args == ('Error downloading "https://www.whatever.com/foo.js" to "js/"',)
 
 
+def test_download_error_streaming(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """\
+        download_root: download_to
+        download:
+          "https://www.whatever.com/foo.js": "js/"
+        """
+    })
+
+    def iter_content(chunk_size=1):
+        yield b'partial content'
+        raise ChunkedEncodingError('connection broken')
+    r = MockResponse()
+    r.iter_content = iter_content
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = r
+    with pytest.raises(GrablibError):
+        Grab().download()
+    assert gettree(tmpworkdir.join('download_to')) == {}
+
+
 def test_no_standard_file():
     with pytest.raises(GrablibError) as excinfo:
         Grab(download_root='test-download-dir')
@@ -319,13 +443,15 @@ def test_lock_zip(mocker, tmpworkdir):
     assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
     tmpworkdir.join('droot/subdirectory/a.txt').remove()
 
+    # the archive is extracted again from the archive cache
     Grab().download()
-    assert mock_requests_get.call_count == 2
+    assert mock_requests_get.call_count == 1
     assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
 
 
 def test_lock_zip_remote_changed(mocker, tmpworkdir):
-    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml})
+    yml = zip_dowload_yml + '\narchive_cache: false'
+    mktree(tmpworkdir, {'grablib.yml': yml})
     mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
     zip_r = request_fixture('https://any-old-url.com/test_assets.zip')
     mock_requests_get.side_effect = [
@@ -334,7 +460,7 @@ def test_lock_zip_remote_changed(mocker, tmpworkdir):
     ]
     Grab().download()
     assert mock_requests_get.call_count == 1
-    assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
+    assert dict(zip_downloaded_directory, **{'grablib.yml': yml}) == gettree(tmpworkdir, max_len=None)
     tmpworkdir.join('droot/subdirectory/a.txt').remove()
 
     with pytest.raises(GrablibError):
@@ -514,3 +640,1032 @@ def test_stale_lock(mocker, tmpworkdir):
                          'b5a3344a4b3651ebd60a1e15309d737c :stale to_delete\n',
         'test-download-dir': {'foo': 'response text'},
     }
+
+
+def test_download_workers(mocker, tmpworkdir):
+    gl = """\
+    download_workers: 4
+    download:
+      'http://wherever.com/file1.js': x
+      'http://wherever.com/file2.js': y
+      'http://wherever.com/file3.js': z
+      'https://any-old-url.com/test_assets.zip':
+        'test_assets/assets/(.+)': 'subdirectory/{filename}'
+    """
+    mktree(tmpworkdir, {'grablib.yml': gl})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+
+    def get(url, **kwargs):
+        if url.endswith('.zip'):
+            return request_fixture(url)
+        return MockResponse()
+    mock_requests_get.side_effect = get
+    Grab(download_root='test-download-dir').download()
+    assert mock_requests_get.call_count == 4
+    assert gettree(tmpworkdir, max_len=0) == {
+        'grablib.yml': gl,
+        'test-download-dir': {
+            'x': 'response text',
+            'y': 'response text',
+            'z': 'response text',
+            'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'},
+        },
+        '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file1.js x\n'
+                         'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file2.js y\n'
+                         'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file3.js z\n'
+                         'b56e6adc64a2a57319285ae64e64d2ec https://any-old-url.com/test_assets.zip :zip-lookup\n'
+                         '0d815adb49aeaa79990afa6387b36014 https://any-old-url.com/test_assets.zip :zip-raw\n'
+                         '60b725f10c9c85c70d97880dfe8191b3 https://any-old-url.com/test_assets.zip subdirectory/a.txt\n'
+                         '3b5d5c3712955042212316173ccf37be https://any-old-url.com/test_assets.zip subdirectory/b.txt\n'
+    }
+    Grab(download_root='test-download-dir', download_workers=2).download()
+    assert mock_requests_get.call_count == 4
+
+
+def test_download_workers_error(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """\
+        download_root: download_to
+        download:
+          "https://www.whatever.com/foo.js": "js/"
+          "https://www.whatever.com/bar.js": "js/"
+        """
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(status_code=404)
+    with pytest.raises(GrablibError) as excinfo:
+        Grab(download_workers=2).download()
+    assert excinfo.value.args == ('Error downloading "https://www.whatever.com/foo.js" to "js/"',)
+    assert not tmpworkdir.join('.grablib.lock').check()
+
+
+def test_download_async(mocker, tmpworkdir):
+    gl = """\
+    download:
+      'http://wherever.com/file1.js': x
+      'https://any-old-url.com/test_assets.zip':
+        'test_assets/assets/(.+)': 'subdirectory/{filename}'
+    """
+    mktree(tmpworkdir, {'grablib.yml': gl})
+    mock_aiohttp_get = mocker.patch('aiohttp.ClientSession.get')
+
+    def get(url, **kwargs):
+        if url.endswith('.zip'):
+            return MockAsyncResponse(content=request_fixture(url).content)
+        return MockAsyncResponse()
+    mock_aiohttp_get.side_effect = get
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(Grab(download_root='test-download-dir').download_async())
+    assert mock_aiohttp_get.call_count == 2
+    assert gettree(tmpworkdir, max_len=0) == {
+        'grablib.yml': gl,
+        'test-download-dir': {
+            'x': 'response text',
+            'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'},
+        },
+        '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file1.js x\n'
+                         'b56e6adc64a2a57319285ae64e64d2ec https://any-old-url.com/test_assets.zip :zip-lookup\n'
+                         '0d815adb49aeaa79990afa6387b36014 https://any-old-url.com/test_assets.zip :zip-raw\n'
+                         '60b725f10c9c85c70d97880dfe8191b3 https://any-old-url.com/test_assets.zip subdirectory/a.txt\n'
+                         '3b5d5c3712955042212316173ccf37be https://any-old-url.com/test_assets.zip subdirectory/b.txt\n'
+    }
+    loop.run_until_complete(Grab(download_root='test-download-dir').download_async())
+    assert mock_aiohttp_get.call_count == 2
+    loop.close()
+
+
+def test_download_async_error(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """\
+        download_root: download_to
+        download:
+          "https://www.whatever.com/foo.js": "js/"
+        """
+    })
+    mock_aiohttp_get = mocker.patch('aiohttp.ClientSession.get')
+    mock_aiohttp_get.return_value = MockAsyncResponse(status=403)
+    loop = asyncio.new_event_loop()
+    with pytest.raises(GrablibError) as excinfo:
+        loop.run_until_complete(Grab().download_async())
+    loop.close()
+    assert excinfo.value.args == ('Error downloading "https://www.whatever.com/foo.js" to "js/"',)
+
+
+def test_download_async_off_loop(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """\
+        download:
+          'https://any-old-url.com/test_assets.zip':
+            'test_assets/assets/(.+)': 'subdirectory/{filename}'
+        """
+    })
+    mock_aiohttp_get = mocker.patch('aiohttp.ClientSession.get')
+    mock_aiohttp_get.return_value = MockAsyncResponse(
+        content=request_fixture('https://any-old-url.com/test_assets.zip').content
+    )
+    threads = []
+    extract_zip = Downloader._extract_zip
+    mocker.patch.object(Downloader, '_extract_zip', autospec=True, side_effect=lambda *args: (
+        threads.append(threading.current_thread()) or extract_zip(*args)
+    ))
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(Grab(download_root='droot').download_async())
+    loop.close()
+    assert gettree(tmpworkdir.join('droot')) == {'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+    # extraction runs in the executor rather than blocking the event loop
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_download_async_retries(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download_backoff: 0\ndownload:\n  'http://wherever.com/file.js': x"
+    })
+    mock_aiohttp_get = mocker.patch('aiohttp.ClientSession.get')
+    mock_aiohttp_get.side_effect = [MockAsyncResponse(status=503), MockAsyncResponse(status=502), MockAsyncResponse()]
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(Grab(download_root='droot').download_async())
+    assert mock_aiohttp_get.call_count == 3
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+    # once retries are exhausted the error is raised
+    tmpworkdir.join('droot/x').remove()
+    mock_aiohttp_get.side_effect = [MockAsyncResponse(status=503)] * 2
+    mktree(tmpworkdir, {
+        'grablib.yml': "download_backoff: 0\ndownload_retries: 1\ndownload:\n  'http://wherever.com/file.js': x"
+    })
+    with pytest.raises(GrablibError):
+        loop.run_until_complete(Grab(download_root='droot').download_async())
+    loop.close()
+    assert mock_aiohttp_get.call_count == 5
+
+
+def test_download_cache(mocker, tmpworkdir):
+    gl = """\
+    download_cache: the-cache
+    download:
+      'http://wherever.com/file.js': x
+      'https://any-old-url.com/test_assets.zip':
+        'test_assets/assets/(.+)': 'subdirectory/{filename}'
+    """
+    mktree(tmpworkdir, {'project1/grablib.yml': gl, 'project2/grablib.yml': gl})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+
+    def get(url, **kwargs):
+        if url.endswith('.zip'):
+            return request_fixture(url)
+        return MockResponse()
+    mock_requests_get.side_effect = get
+    Grab('project1/grablib.yml', download_root='project1/droot').download()
+    assert mock_requests_get.call_count == 2
+    assert tmpworkdir.join('the-cache/0d/0d815adb49aeaa79990afa6387b36014').check()
+    assert tmpworkdir.join('the-cache/b5/b5a3344a4b3651ebd60a1e15309d737c').read() == 'response text'
+
+    # the lock file is in the working directory so is shared, project2's files are all copied from the cache
+    Grab('project2/grablib.yml', download_root='project2/droot').download()
+    assert mock_requests_get.call_count == 2
+    assert gettree(tmpworkdir.join('project2/droot')) == gettree(tmpworkdir.join('project1/droot'))
+
+
+def test_download_cache_corrupt(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download_cache: the-cache\ndownload:\n  'http://wherever.com/file.js': x",
+        '.grablib.lock': 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n',
+        'the-cache/b5/b5a3344a4b3651ebd60a1e15309d737c': 'wrong',
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+    assert gettree(tmpworkdir.join('the-cache')) == {'b5': {'b5a3344a4b3651ebd60a1e15309d737c': 'response text'}}
+
+
+def test_download_cache_evict(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': (
+            'download_cache: the-cache\n'
+            'download_cache_max_size: 20\n'
+            "download:\n  'http://wherever.com/file.js': x"
+        ),
+        'the-cache/aa/' + 'a' * 32: 'old cached file',
+    })
+    tmpworkdir.join('the-cache/aa/' + 'a' * 32).setmtime(1000000000)
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('the-cache')) == {
+        'aa': {},
+        'b5': {'b5a3344a4b3651ebd60a1e15309d737c': 'response text'},
+    }
+
+
+def test_download_cache_env(mocker, tmpworkdir, monkeypatch):
+    monkeypatch.setenv('GRABLIB_CACHE_DIR', str(tmpworkdir.join('env-cache')))
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    assert tmpworkdir.join('env-cache/b5/b5a3344a4b3651ebd60a1e15309d737c').check()
+
+
+def test_lock_validators(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download:\n  'http://wherever.com/file.js': x"
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [
+        MockResponse(headers={'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+        MockResponse(status_code=304, content=b'', headers={}),
+    ]
+    Grab(download_root='droot').download()
+    lock = (
+        '"abc" http://wherever.com/file.js :etag\n'
+        'Wed,%2021%20Oct%202015%2007:28:00%20GMT http://wherever.com/file.js :last-modified\n'
+        'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n'
+    )
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 1
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+    # renaming the destination means a request is required, but the old file can be reused
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': y"})
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 2
+    mock_requests_get.assert_called_with('http://wherever.com/file.js', stream=True, headers={
+        'If-None-Match': '"abc"',
+        'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT',
+    })
+    assert gettree(tmpworkdir.join('droot')) == {'y': 'response text'}
+    assert tmpworkdir.join('.grablib.lock').read() == lock.replace('file.js x', 'file.js y') + (
+        '# "stale" files which grablib should delete where found, you can delete these once everyone has run grablib\n'
+        'b5a3344a4b3651ebd60a1e15309d737c :stale x\n'
+    )
+
+
+def test_lock_validators_no_local_copy(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download:\n  'http://wherever.com/file.js': x",
+        '.grablib.lock': (
+            '"abc" http://wherever.com/file.js :etag\n'
+            'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n'
+        ),
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(headers={'ETag': '"abc"'})
+    Grab(download_root='droot').download()
+    mock_requests_get.assert_called_with('http://wherever.com/file.js', stream=True, headers={})
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def broken_response(content, **kwargs):
+    def iter_content(chunk_size=1):
+        yield content
+        raise ChunkedEncodingError('connection broken')
+    r = MockResponse(**kwargs)
+    r.iter_content = iter_content
+    return r
+
+
+def test_resume_download(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [
+        broken_response(b'respon', headers={'ETag': '"abc"'}),
+        MockResponse(status_code=206, content=b'se text', headers={'Content-Range': 'bytes 6-12/13'}),
+    ]
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    part = '.grablib-{}.part'.format(hashlib.md5(b'http://wherever.com/file.js').hexdigest())
+    assert gettree(tmpworkdir.join('droot')) == {part: 'respon', part + '-validator': '"abc"'}
+
+    Grab(download_root='droot').download()
+    mock_requests_get.assert_called_with(
+        'http://wherever.com/file.js', stream=True, headers={'Range': 'bytes=6-', 'If-Range': '"abc"'}
+    )
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+    assert tmpworkdir.join('.grablib.lock').read() == 'b5a3344a4b3651ebd60a1e15309d737c http://wherever.com/file.js x\n'
+
+
+def test_resume_download_async(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = broken_response(b'respon', headers={'ETag': '"abc"'})
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+
+    mock_aiohttp_get = mocker.patch('aiohttp.ClientSession.get')
+    mock_aiohttp_get.return_value = MockAsyncResponse(
+        status=206, content=b'se text', headers={'Content-Range': 'bytes 6-12/13'}
+    )
+    threads = []
+    open_part = PartialDownload._open
+    mocker.patch.object(PartialDownload, '_open', autospec=True, side_effect=lambda *args: (
+        threads.append(threading.current_thread()) or open_part(*args)
+    ))
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(Grab(download_root='droot').download_async())
+    loop.close()
+    assert mock_aiohttp_get.call_args[1]['headers'] == {'Range': 'bytes=6-', 'If-Range': '"abc"'}
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+    # the partial download is hashed in the executor rather than on the event loop
+    assert threads and threads[0] is not threading.main_thread()
+
+
+def test_resume_download_changed(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [
+        broken_response(b'old con', headers={'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}),
+        MockResponse(),
+    ]
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_args[1]['headers'] == {
+        'Range': 'bytes=7-', 'If-Range': 'Wed, 21 Oct 2015 07:28:00 GMT'
+    }
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_resume_download_not_satisfiable(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'http://wherever.com/file.js': x"})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [
+        broken_response(b'something longer than the file', headers={'ETag': '"abc"'}),
+        MockResponse(status_code=416),
+        MockResponse(),
+    ]
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 3
+    mock_requests_get.assert_called_with('http://wherever.com/file.js', stream=True, headers={})
+    assert gettree(tmpworkdir.join('droot')) == {'x': 'response text'}
+
+
+def test_stat_cache(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    file_hash = mocker.spy(Downloader, '_file_hash')
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+    assert file_hash.call_count == 0
+
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+    assert file_hash.call_count == 0
+
+    Grab(paranoid=True).download()
+    assert mock_requests_get.call_count == 1
+    assert file_hash.call_count == 2
+
+    tmpworkdir.join('droot/subdirectory/a.txt').write('x\n')
+    Grab().download()
+    assert file_hash.call_count == 3
+    assert mock_requests_get.call_count == 1
+    assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
+    # the cache is kept next to the lock file rather than in the shared temp directory
+    assert tmpworkdir.join('.grablib.lock.stat-cache').check()
+
+    # an unreadable cache, eg. from a run which was killed, is ignored
+    tmpworkdir.join('.grablib.lock.stat-cache').write('{"trunc')
+    Grab().download()
+    assert file_hash.call_count == 5
+    assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
+    Grab().download()
+    assert file_hash.call_count == 5
+
+
+@pytest.mark.parametrize('pattern,prefix', [
+    ('test_assets/assets/(.+)', 'test_assets/assets/'),
+    ('bootstrap-sass-3.3.6/assets/(.+)$', 'bootstrap-sass-3'),
+    ('abc*', 'ab'),
+    ('ab?c', 'a'),
+    ('a{2}', ''),
+    ('foo|bar', ''),
+    ('(?i)foo', ''),
+    (r'\.foo', ''),
+])
+def test_zip_routes_prefix(pattern, prefix):
+    assert ZipRoutes.literal_prefix(pattern) == prefix
+
+
+def test_zip_routes():
+    routes = ZipRoutes(OrderedDict([
+        ('pkg/assets/a.txt', None),
+        ('pkg/assets/(.+)', 'sub/'),
+        ('pkg/(?P<dir>[^/]+)/(?P<filename>.+)', ['{dir}/', 'other/{filename}']),
+    ]))
+    assert routes.route('pkg/assets/a.txt')[:2] == ('pkg/assets/a.txt', None)
+    pattern, targets, m = routes.route('pkg/assets/b.txt')
+    assert (pattern, targets, m.groups()) == ('pkg/assets/(.+)', ['sub/'], ('b.txt',))
+    pattern, targets, m = routes.route('pkg/fonts/c.ttf')
+    assert m.groupdict() == {'dir': 'fonts', 'filename': 'c.ttf'}
+    assert routes.route('other/pkg/assets/a.txt') is None
+
+
+def test_zip_unchanged_members_not_rewritten(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    b_path = tmpworkdir.join('droot/subdirectory/b.txt')
+    b_path.setmtime(1000000000)
+    tmpworkdir.join('droot/subdirectory/a.txt').remove()
+
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+    assert b_path.mtime() == 1000000000
+    assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
+
+    # same size but different content means the CRC doesn't match so the file is rewritten
+    b_path.write('x\n')
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+    assert zip_downloaded_directory == gettree(tmpworkdir, max_len=None)
+
+
+def test_archive_cache_rules_changed(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml.replace('subdirectory/{filename}', 'new/{filename}')})
+    Grab().download()
+    assert mock_requests_get.call_count == 1
+    assert gettree(tmpworkdir.join('droot')) == {'new': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+
+
+def test_archive_cache_retain(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': zip_dowload_yml + '\narchive_cache: archives',
+        'archives': {
+            'keep.txt': 'keep',
+            'sub': {'nested': {'x': 'x'}},
+        },
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    project_dir, = tmpworkdir.join('archives').listdir('grablib_archives.*')
+    assert sorted(p.relto(project_dir) for p in project_dir.visit()) == [
+        '0d', '0d/0d815adb49aeaa79990afa6387b36014'
+    ]
+
+    mktree(project_dir, {'ab': {'other.txt': 'other', 'nested': {}}})
+    mktree(tmpworkdir, {'grablib.yml': 'download: {}\narchive_cache: archives'})
+    Grab(download_root='droot').download()
+    # empty prefix directories are removed but other content is left alone
+    assert gettree(project_dir) == {'ab': {'other.txt': 'other', 'nested': {}}}
+    assert gettree(tmpworkdir.join('archives/sub')) == {'nested': {'x': 'x'}}
+    assert tmpworkdir.join('archives/keep.txt').read() == 'keep'
+
+    # once nothing is left the project's directory is removed
+    project_dir.join('ab').remove()
+    Grab(download_root='droot').download()
+    assert not project_dir.check()
+
+
+def test_archive_cache_default(mocker, tmpworkdir, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpworkdir.join('cache')))
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    project_dir, = tmpworkdir.join('cache/grablib/archives').listdir()
+    assert project_dir.stat().mode & 0o777 == 0o700
+    assert project_dir.join('0d/0d815adb49aeaa79990afa6387b36014').check()
+
+
+def test_archive_cache_insecure(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml + '\narchive_cache: archives'})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    project_dir, = tmpworkdir.join('archives').listdir()
+    # a directory other users could have put archives in isn't used
+    project_dir.chmod(0o777)
+    tmpworkdir.join('droot/subdirectory/a.txt').remove()
+    Grab().download()
+    assert mock_requests_get.call_count == 2
+    assert gettree(tmpworkdir.join('droot')) == {'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+
+
+def test_zip_ranges(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml + '\nzip_ranges: true'})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = range_request_fixture
+    Grab().download()
+    assert all('Range' in c[1]['headers'] for c in mock_requests_get.call_args_list)
+    assert gettree(tmpworkdir.join('droot')) == {'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+    lock = tmpworkdir.join('.grablib.lock').read()
+    assert ':zip-index' in lock
+    assert ':zip-raw' not in lock
+
+    tmpworkdir.join('droot/subdirectory/a.txt').remove()
+    Grab().download()
+    assert gettree(tmpworkdir.join('droot')) == {'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+    # without range support the archive is downloaded in full and its central directory checked against the lock
+    tmpworkdir.join('droot/subdirectory/a.txt').remove()
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    assert gettree(tmpworkdir.join('droot')) == {'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+
+def test_zip_ranges_limited(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml + '\nzip_ranges: true\ndownload_rate_limit: 1000000000'})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = range_request_fixture
+    host_semaphore = mocker.spy(Downloader, '_host_semaphore')
+    reserve = mocker.spy(RateLimiter, 'reserve')
+    Grab().download()
+    assert gettree(tmpworkdir.join('droot')) == {'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+    # range requests are subject to host_concurrency and download_rate_limit like full downloads
+    assert host_semaphore.call_count == mock_requests_get.call_count
+    assert sum(c[0][1] for c in reserve.call_args_list) == sum(
+        len(range_request_fixture(c[0][0], **c[1]).content) for c in mock_requests_get.call_args_list
+    )
+
+
+def test_zip_ranges_not_supported(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml + '\nzip_ranges: true'})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = request_fixture
+    Grab().download()
+    assert mock_requests_get.call_count == 2
+    assert gettree(tmpworkdir.join('droot')) == {'subdirectory': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+    assert ':zip-raw' in tmpworkdir.join('.grablib.lock').read()
+
+
+def test_zip_ranges_large_archive(mocker, tmpworkdir):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for i in range(10):
+            zipf.writestr('big/{}.bin'.format(i), os.urandom(200 * 1024))
+        zipf.writestr('small/wanted.txt', 'wanted')
+    content = buffer.getvalue()
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        zip_ranges: true
+        download:
+          'https://any-old-url.com/big.zip':
+            'small/(.+)': '{filename}'
+        """
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = lambda url, headers=None, **kwargs: range_response(content, headers)
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {'wanted.txt': 'wanted'}
+    fetched = sum(len(r.content) for r in [range_response(content, c[1]['headers'])
+                                           for c in mock_requests_get.call_args_list])
+    assert fetched < 200 * 1024
+
+
+def test_zip_ranges_archive_changed(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml + '\nzip_ranges: true'})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = range_request_fixture
+    Grab().download()
+    tmpworkdir.join('droot/subdirectory/a.txt').remove()
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        zipf.writestr('test_assets/assets/a.txt', 'changed\n')
+    mock_requests_get.side_effect = lambda url, headers=None, **kwargs: range_response(buffer.getvalue(), headers)
+    with pytest.raises(GrablibError):
+        Grab().download()
+
+
+def test_zip_ranges_member_hash_checked(mocker, tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml + '\nzip_ranges: true'})
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = range_request_fixture
+    Grab().download()
+    tmpworkdir.join('droot/subdirectory/a.txt').remove()
+
+    # the central directory is unchanged but a.txt no longer matches its md5 in the lock
+    lock = tmpworkdir.join('.grablib.lock').read()
+    lock = re.sub(r'^\w+ (\S+ subdirectory/a.txt)$', r'{} \1'.format('0' * 32), lock, flags=re.M)
+    tmpworkdir.join('.grablib.lock').write(lock)
+    with pytest.raises(GrablibError):
+        Grab().download()
+    assert not tmpworkdir.join('droot/subdirectory/a.txt').check()
+
+    # once extraction rules change destinations may come from different members so aren't compared
+    mktree(tmpworkdir, {'grablib.yml': zip_dowload_yml.replace('subdirectory', 'new') + '\nzip_ranges: true'})
+    Grab().download()
+    assert gettree(tmpworkdir.join('droot')) == {'new': {'a.txt': 'a\n', 'b.txt': 'b\n'}}
+
+
+def tarball_content(files, mode='w:gz'):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as tarf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tarf.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('mode', ['w:gz', 'w:bz2', 'w'])
+def test_tarball(mocker, tmpworkdir, mode):
+    content = tarball_content({
+        'package/package.json': b'{}',
+        'package/dist/a.js': b'var a;',
+        'package/dist/b.js': b'var b;',
+    }, mode)
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        download:
+          'https://registry.npmjs.org/x/-/x-1.0.0.tgz':
+            'package/dist/b.js': null
+            'package/dist/(.+)': 'x/{filename}'
+        """
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(content=content)
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {'x': {'a.js': 'var a;'}}
+    lock = tmpworkdir.join('.grablib.lock').read()
+    assert hashlib.md5(content).hexdigest() + ' https://registry.npmjs.org/x/-/x-1.0.0.tgz :zip-raw' in lock
+
+    mtime = tmpworkdir.join('droot/x/a.js').mtime()
+    tmpworkdir.join('droot/x/a.js').setmtime(mtime - 10)
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        archive_cache: false
+        download:
+          'https://registry.npmjs.org/x/-/x-1.0.0.tgz':
+            'package/dist/(.+)': 'x/{filename}'
+        """
+    })
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {'x': {'a.js': 'var a;', 'b.js': 'var b;'}}
+    # unchanged files aren't rewritten
+    assert tmpworkdir.join('droot/x/a.js').mtime() == mtime - 10
+
+
+def test_transport_adapter(mocker):
+    downloader = Downloader(download_root='droot', download={}, download_timeout=[2, 5], download_retries=4,
+                            download_pool_size=20)
+    adapter = downloader._session.get_adapter('https://www.example.com')
+    assert adapter.max_retries.total == 4
+    assert adapter._pool_maxsize == 20
+    mock_send = mocker.patch('grablib.download.HTTPAdapter.send')
+    adapter.send('request')
+    mock_send.assert_called_with('request', timeout=(2, 5))
+    adapter.send('request', timeout=1)
+    mock_send.assert_called_with('request', timeout=1)
+
+    mocker.patch('grablib.download.time.monotonic', return_value=100)
+    adapter.deadline = 103
+    adapter.send('request')
+    mock_send.assert_called_with('request', timeout=(2, 3))
+    adapter.deadline = 99
+    with pytest.raises(DeadlineExceeded):
+        adapter.send('request')
+
+
+def test_download_deadline(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download_deadline: 10\ndownload:\n  'http://wherever.com/file.js': x"
+    })
+    mocker.patch('grablib.download.time.monotonic', side_effect=[0, 100])
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse()
+    with pytest.raises(GrablibError) as exc_info:
+        Grab(download_root='droot').download()
+    assert exc_info.value.__cause__.args[0] == 'request error'
+    assert isinstance(exc_info.value.__cause__.__cause__, DeadlineExceeded)
+    assert not tmpworkdir.join('droot/x').check()
+
+
+def test_mirrors_fastest_first(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        aliases:
+          MIRRORED: ['http://slow.com/libs', 'http://fast.com/libs', 'http://down.com/libs']
+        download:
+          'MIRRORED/foo.js': foo.js
+        """
+    })
+    latencies = {'http://slow.com/libs': 0.5, 'http://fast.com/libs': 0.1, 'http://down.com/libs': None}
+    mocker.patch.object(Downloader, '_probe_mirror', side_effect=lambda session, mirror: latencies[mirror])
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = [MockResponse(status_code=503), MockResponse()]
+    Grab(download_root='droot').download()
+    assert [c[0][0] for c in mock_requests_get.call_args_list] == [
+        'http://fast.com/libs/foo.js',
+        'http://slow.com/libs/foo.js',
+    ]
+    assert gettree(tmpworkdir.join('droot')) == {'foo.js': 'response text'}
+    assert tmpworkdir.join('.grablib.lock').read() == (
+        'b5a3344a4b3651ebd60a1e15309d737c http://slow.com/libs/foo.js foo.js\n'
+    )
+
+
+def test_mirrors_local(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'mirror/foo.js': 'local copy',
+    })
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        aliases:
+          MIRRORED: ['http://remote.com/libs', 'file://{}']
+        download:
+          'MIRRORED/foo.js': foo.js
+        """.format(tmpworkdir.join('mirror'))
+    })
+    mock_requests_head = mocker.patch('grablib.download.requests.Session.head')
+    mock_requests_head.return_value = MockResponse()
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    Grab(download_root='droot').download()
+    assert mock_requests_head.call_count == 1
+    assert mock_requests_get.call_count == 0
+    assert gettree(tmpworkdir.join('droot')) == {'foo.js': 'local copy'}
+    assert 'http://remote.com/libs/foo.js foo.js' in tmpworkdir.join('.grablib.lock').read()
+
+    # mirrors are only probed when something needs downloading
+    Grab(download_root='droot').download()
+    assert mock_requests_head.call_count == 1
+
+
+def test_redirect_location(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download:\n  'https://git.io/short': x.js",
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(url='https://example.com/path/to/x.js?v=1')
+    Grab(download_root='droot').download()
+    lock = tmpworkdir.join('.grablib.lock').read()
+    assert lock == (
+        'https://example.com/path/to/x.js%3Fv%3D1 https://git.io/short :location\n'
+        'b5a3344a4b3651ebd60a1e15309d737c https://git.io/short x.js\n'
+    )
+
+    tmpworkdir.join('droot/x.js').remove()
+    mock_requests_get.return_value = MockResponse()
+    Grab(download_root='droot').download()
+    mock_requests_get.assert_called_with('https://example.com/path/to/x.js?v=1', headers={}, stream=True)
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+    # the original url is used if the location fails
+    tmpworkdir.join('droot/x.js').remove()
+    mock_requests_get.side_effect = [MockResponse(status_code=404), MockResponse()]
+    Grab(download_root='droot').download()
+    mock_requests_get.assert_called_with('https://git.io/short', headers={}, stream=True)
+    assert tmpworkdir.join('droot/x.js').read() == 'response text'
+    assert tmpworkdir.join('.grablib.lock').read() == 'b5a3344a4b3651ebd60a1e15309d737c https://git.io/short x.js\n'
+
+
+def test_redirect_location_async(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download:\n  'https://git.io/short': x.js",
+    })
+    mock_get = mocker.patch('aiohttp.ClientSession.get')
+    mock_get.return_value = MockAsyncResponse(url='https://example.com/x.js')
+    asyncio.new_event_loop().run_until_complete(Grab(download_root='droot').download_async())
+    assert 'https://example.com/x.js https://git.io/short :location\n' in tmpworkdir.join('.grablib.lock').read()
+
+
+def test_local_file(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'checkout': {
+            'dist': {'lib.js': 'var lib;', 'other.js': 'var other;'},
+        },
+        'grablib.yml': """
+        download:
+          'checkout/dist/lib.js': js/
+          'file://{}/checkout/dist/other.js': other.js
+        """.format(tmpworkdir)
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 0
+    assert gettree(tmpworkdir.join('droot')) == {'js': {'lib.js': 'var lib;'}, 'other.js': 'var other;'}
+    lock = tmpworkdir.join('.grablib.lock').read()
+    assert '{} checkout/dist/lib.js js/lib.js\n'.format(hashlib.md5(b'var lib;').hexdigest()) in lock
+
+    Grab(download_root='droot').download()
+    assert tmpworkdir.join('.grablib.lock').read() == lock
+
+    tmpworkdir.join('checkout/dist/lib.js').write('var changed;')
+    tmpworkdir.join('droot/js/lib.js').remove()
+    with pytest.raises(GrablibError):
+        Grab(download_root='droot').download()
+
+
+def test_local_file_missing(tmpworkdir):
+    mktree(tmpworkdir, {'grablib.yml': "download:\n  'checkout/missing.js': x.js"})
+    with pytest.raises(GrablibError) as exc_info:
+        Grab(download_root='droot').download()
+    assert exc_info.value.__cause__.args[0] == 'file not found'
+
+
+def test_local_file_hardlink(tmpworkdir):
+    mktree(tmpworkdir, {
+        'lib.js': 'var lib;',
+        'grablib.yml': "hardlink_local: true\ndownload:\n  'lib.js': lib.js",
+    })
+    Grab(download_root='droot').download()
+    assert os.path.samefile(str(tmpworkdir.join('lib.js')), str(tmpworkdir.join('droot/lib.js')))
+
+
+def test_local_directory(tmpworkdir):
+    mktree(tmpworkdir, {
+        'checkout': {
+            'a.js': 'var a;',
+            'sub': {'b.js': 'var b;', 'c.css': 'c {}'},
+        },
+        'grablib.yml': """
+        download:
+          'checkout':
+            '(.+)\\.js$': 'js/{filename}.js'
+        """
+    })
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {'js': {'a.js': 'var a;', 'sub': {'b.js': 'var b;'}}}
+
+    tmpworkdir.join('checkout/a.js').remove()
+    tmpworkdir.join('checkout/sub/d.js').write('var d;')
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {'js': {'sub': {'b.js': 'var b;', 'd.js': 'var d;'}}}
+
+
+def test_local_directory_hash_changed(tmpworkdir):
+    mktree(tmpworkdir, {
+        'checkout': {'a.js': 'var a;', 'b.js': 'var b;'},
+        'grablib.yml': """
+        download:
+          'checkout':
+            '(.+)\\.js$': 'js/{filename}.js'
+        """
+    })
+    Grab(download_root='droot').download()
+    tmpworkdir.join('checkout/a.js').write('var changed;')
+    with pytest.raises(GrablibError) as exc_info:
+        Grab(download_root='droot').download()
+    assert exc_info.value.__cause__.args[0] == 'remote hash mismatch'
+    assert tmpworkdir.join('droot/js/a.js').read() == 'var a;'
+
+    tmpworkdir.join('grablib.yml').write("download:\n  'checkout':\n    '(.+)\\.js$': 'lib/{filename}.js'")
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {'lib': {'a.js': 'var changed;', 'b.js': 'var b;'}}
+
+
+@pytest.mark.parametrize('disable', [(), ('fcntl',), ('fcntl', 'copy_file_range'),
+                                     ('fcntl', 'copy_file_range', 'sendfile')])
+def test_clone_file(tmpdir, mocker, disable):
+    src = tmpdir.join('src.bin')
+    src.write_binary(os.urandom(300 * 1024))
+    if 'fcntl' in disable:
+        mocker.patch('grablib.download.fcntl', None)
+    for method in ('copy_file_range', 'sendfile'):
+        if method in disable:
+            mocker.patch('grablib.download.os.' + method, side_effect=OSError('not supported'), create=True)
+    method = clone_file(Path(str(src)), Path(str(tmpdir.join('dst.bin'))))
+    assert tmpdir.join('dst.bin').read_binary() == src.read_binary()
+    if len(disable) == 3:
+        assert method == 'copy'
+    with pytest.raises(FileExistsError):
+        clone_file(Path(str(src)), Path(str(tmpdir.join('dst.bin'))))
+
+
+@pytest.mark.parametrize('dedup', [True, False])
+def test_dedup(mocker, tmpworkdir, dedup):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        dedup: {}
+        download:
+          'https://any-old-url.com/test_assets.zip':
+            'test_assets/assets/a.txt':
+              - a.txt
+              - again/a.txt
+          'https://example.com/a.txt': copy/a.txt
+        """.format('true' if dedup else 'false')
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = lambda url, **kwargs: (
+        request_fixture(url) if url.endswith('.zip') else MockResponse(content=b'a\n')
+    )
+    Grab(download_root='droot').download()
+    assert gettree(tmpworkdir.join('droot')) == {'a.txt': 'a\n', 'again': {'a.txt': 'a\n'}, 'copy': {'a.txt': 'a\n'}}
+    a = str(tmpworkdir.join('droot/a.txt'))
+    assert os.path.samefile(a, str(tmpworkdir.join('droot/again/a.txt'))) is dedup
+    assert os.path.samefile(a, str(tmpworkdir.join('droot/copy/a.txt'))) is dedup
+
+    # files from previous runs are found using the lock
+    tmpworkdir.join('droot/copy/a.txt').remove()
+    Grab(download_root='droot').download()
+    assert os.path.samefile(a, str(tmpworkdir.join('droot/copy/a.txt'))) is dedup
+
+
+def test_dedup_then_copy(mocker, tmpworkdir):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        zipf.writestr('m1.txt', 'same\n')
+        zipf.writestr('m2.txt', 'same\n')
+        zipf.writestr('m3.txt', 'different\n')
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(content=buffer.getvalue())
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        dedup: true
+        download:
+          'https://example.com/files.zip':
+            'm1.txt': A
+            'm2.txt': B
+        """
+    })
+    Grab(download_root='droot').download()
+    assert os.path.samefile(str(tmpworkdir.join('droot/A')), str(tmpworkdir.join('droot/B')))
+
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        download:
+          'https://example.com/files.zip':
+            'm1.txt': A
+            'm3.txt': [C, B]
+        """
+    })
+    Grab(download_root='droot').download()
+    # B is replaced rather than written to, so A which was linked to it keeps its content
+    assert gettree(tmpworkdir.join('droot')) == {'A': 'same\n', 'B': 'different\n', 'C': 'different\n'}
+    assert not os.path.samefile(str(tmpworkdir.join('droot/A')), str(tmpworkdir.join('droot/B')))
+
+
+def test_dedup_no_links(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        dedup: true
+        download:
+          'https://example.com/a.txt': a.txt
+          'https://example.com/b.txt': copy/a.txt
+        """
+    })
+    mocker.patch('grablib.download.requests.Session.get', return_value=MockResponse(content=b'a\n'))
+    mocker.patch('grablib.download.fcntl', None)
+    mocker.patch('grablib.download.os.link', side_effect=OSError('not supported'))
+    mock_copy = mocker.patch('grablib.download.os.copy_file_range', create=True)
+    Grab(download_root='droot').download()
+    # without hard links or reflinks the new download is moved into place rather than copying the existing file
+    assert gettree(tmpworkdir.join('droot')) == {'a.txt': 'a\n', 'copy': {'a.txt': 'a\n'}}
+    assert not mock_copy.called
+
+
+def test_host_concurrency(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': """
+        download_workers: 4
+        host_concurrency: 2
+        download:
+          'http://wherever.com/file1.js': w
+          'http://wherever.com/file2.js': x
+          'http://wherever.com/file3.js': y
+          'http://wherever.com/file4.js': z
+        """
+    })
+    active, max_active = [], []
+    mutex = threading.Lock()
+
+    def get(url, **kwargs):
+        with mutex:
+            active.append(url)
+            max_active.append(len(active))
+        time.sleep(0.05)
+        with mutex:
+            active.remove(url)
+        return MockResponse()
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.side_effect = get
+    Grab(download_root='droot').download()
+    assert mock_requests_get.call_count == 4
+    assert max(max_active) == 2
+
+
+def test_rate_limiter(mocker):
+    mocker.patch('grablib.download.time.monotonic', return_value=10)
+    limiter = RateLimiter(1000)
+    assert limiter.reserve(500) == 0
+    assert limiter.reserve(1000) == 0.5
+    assert limiter.reserve(100) == 1.5
+
+
+def test_download_rate_limit(mocker, tmpworkdir):
+    mktree(tmpworkdir, {
+        'grablib.yml': "download_rate_limit: 4\ndownload:\n  'http://wherever.com/file.js': x"
+    })
+    mock_requests_get = mocker.patch('grablib.download.requests.Session.get')
+    mock_requests_get.return_value = MockResponse(content=b'12345678')
+    mock_sleep = mocker.patch('grablib.download.time.sleep')
+    mocker.patch('grablib.download.time.monotonic', return_value=10)
+    Grab(download_root='droot').download()
+    assert tmpworkdir.join('droot/x').read() == '12345678'
+    assert mock_sleep.call_args_list == [mocker.call(0)]